@@ -0,0 +1,296 @@
+"""Deterministic sync and report benchmarks against a local stand-in for the Calendar API.
+
+    python manage.py benchmark [--scenario NAME] [--save]
+
+Each benchmark records wall time, query count (CaptureQueriesContext) and peak traced memory.
+Results are compared against baseline.json, wall times are measured with tracemalloc running.
+The synthetic calendars and the report windows are anchored on NOW, so runs don't drift with the date"""
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from audit.calendar_manager import CalendarManager
+from audit.models import Calendar, User
+from audit.reports import ReportBuilder
+
+BASELINE = Path(__file__).with_name("baseline.json")
+
+REPORTS = [
+    "get_time_per_month",
+    "get_most_and_least_meetings",
+    "get_busiest_weeks",
+    "get_avg_meetings_week",
+    "get_avg_time_meetings_week",
+    "get_top_collaborators",
+    "get_time_recruiting",
+]
+
+
+class Scenario:
+    """Shape of a synthetic calendar.
+    recurring is the share of events that are occurrences of weekly series, cancelled the share of
+    occurrences (and of the changes of the incremental sync) that are cancellations, changed the share
+    of events modified before the incremental sync"""
+
+    def __init__(
+        self,
+        name: str,
+        num_events=1000,
+        attendees=5,
+        recurring=0.3,
+        cancelled=0.05,
+        changed=0.05,
+        page_size=250,
+        expand_recurring=True,
+        seed=0,
+    ) -> None:
+        self.name = name
+        self.num_events = num_events
+        self.attendees = attendees
+        self.recurring = recurring
+        self.cancelled = cancelled
+        self.changed = changed
+        self.page_size = page_size
+        self.expand_recurring = expand_recurring
+        self.seed = seed
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+SCENARIOS = {
+    "expanded": Scenario("expanded"),
+    "masters": Scenario("masters", expand_recurring=False),
+}
+
+# The current time as seen by the synthetic calendars and the reports
+NOW = datetime(2024, 6, 17, 12, tzinfo=timezone.utc)
+
+# Occurrences of every synthetic series
+SERIES_LENGTH = 10
+
+# (factor, slack) each metric may grow by before it counts as a regression. Wall times vary between
+# machines, query counts are deterministic
+TOLERANCE = {"wall": [3.0, 0.05], "queries": [1.0, 0], "peak_kb": [1.5, 64]}
+
+
+def _time(dt: datetime) -> dict:
+    return {"dateTime": dt.isoformat()}
+
+
+def _merge(versions: list[list[dict]]) -> list[dict]:
+    """The latest version of every item changed in the versions"""
+    merged = {}
+    for items in versions:
+        for item in items:
+            merged[item["id"]] = item
+    return list(merged.values())
+
+
+class FakeCalendarService:
+    """Serves a synthetic calendar through service.events().list() the way the Calendar API does:
+    pages of page_size items, a nextSyncToken on the last page and, for a sync token, only the items
+    changed since it was handed out. Time ranges aren't supported, the harness syncs without a window"""
+
+    def __init__(self, items: list[dict], page_size: int) -> None:
+        self.page_size = page_size
+        # The items changed in each version, version 0 is the initial state of the calendar
+        self.versions = [items]
+
+    def events(self):
+        return self
+
+    def list(self, pageToken=None, syncToken=None, singleEvents=True, **kwargs):
+        if syncToken:
+            items = _merge(self.versions[int(syncToken) :])
+        else:
+            items = [
+                item
+                for item in _merge(self.versions)
+                # Only a listing of masters includes (the cancelled exceptions of) deleted occurrences
+                if item["status"] != "cancelled" or (not singleEvents and "recurringEventId" in item)
+            ]
+
+        offset = int(pageToken or 0)
+        result = {"items": items[offset : offset + self.page_size]}
+        if offset + self.page_size < len(items):
+            result["nextPageToken"] = str(offset + self.page_size)
+        else:
+            result["nextSyncToken"] = str(len(self.versions))
+        return _Request(result)
+
+    def change(self, scenario: Scenario, rng: random.Random) -> None:
+        """Modifies or cancels a share of the stored events, as seen by the next incremental sync"""
+        current = [item for item in _merge(self.versions) if item["status"] != "cancelled"]
+        updated = datetime(2030, 1, 1, tzinfo=timezone.utc).isoformat()
+        changes = []
+        for item in rng.sample(current, int(len(current) * scenario.changed)):
+            if rng.random() < scenario.cancelled:
+                changes.append({"id": item["id"], "status": "cancelled"})
+            else:
+                changes.append({**item, "summary": f"{item['summary']} (moved)", "updated": updated})
+        self.versions.append(changes)
+
+
+class _Request:
+    def __init__(self, result: dict) -> None:
+        self.result = result
+
+    def execute(self) -> dict:
+        return self.result
+
+
+def make_items(scenario: Scenario, owner: str, now: datetime, rng: random.Random) -> list[dict]:
+    """The synthetic events of the calendar, spread over the four months before now"""
+    people = [f"person{i}@example.com" for i in range(max(scenario.attendees * 4, 1))]
+    window_start = (now - timedelta(days=120)).replace(minute=0, second=0, microsecond=0)
+    updated = datetime(2022, 1, 1, tzinfo=timezone.utc).isoformat()
+
+    def event(g_id: str, start: datetime, summary: str) -> dict:
+        return {
+            "id": g_id,
+            "status": "confirmed",
+            "summary": summary,
+            "eventType": "default",
+            "updated": updated,
+            "start": _time(start),
+            "end": _time(start + timedelta(minutes=30 * rng.randint(1, 4))),
+            "organizer": {"email": owner if rng.random() < 0.5 else rng.choice(people)},
+            "attendees": [{"email": owner, "responseStatus": "accepted"}]
+            + [
+                {"email": email, "responseStatus": "accepted"}
+                for email in rng.sample(people, min(scenario.attendees, len(people)))
+            ],
+        }
+
+    def slot(days: int) -> datetime:
+        return window_start + timedelta(days=rng.randrange(days), hours=rng.randrange(8, 18))
+
+    items = []
+    num_recurring = int(scenario.num_events * scenario.recurring)
+    series = 0
+    while num_recurring > 0:
+        count = min(SERIES_LENGTH, num_recurring)
+        num_recurring -= count
+        master = event(f"series{series}", slot(120 - 7 * count), "Interview loop" if series % 5 == 0 else "Sync")
+        series += 1
+        first = datetime.fromisoformat(master["start"]["dateTime"])
+        duration = datetime.fromisoformat(master["end"]["dateTime"]) - first
+
+        exceptions = []
+        for week in range(count):
+            start = first + timedelta(weeks=week)
+            instance_id = f"{master['id']}_{start.astimezone(timezone.utc):%Y%m%dT%H%M%SZ}"
+            cancelled = rng.random() < scenario.cancelled
+            if scenario.expand_recurring:
+                if not cancelled:
+                    items.append(
+                        {
+                            **master,
+                            "id": instance_id,
+                            "start": _time(start),
+                            "end": _time(start + duration),
+                            "recurringEventId": master["id"],
+                            "originalStartTime": _time(start),
+                        }
+                    )
+            elif cancelled:
+                exceptions.append(
+                    {
+                        "id": instance_id,
+                        "status": "cancelled",
+                        "recurringEventId": master["id"],
+                        "originalStartTime": _time(start),
+                    }
+                )
+
+        if not scenario.expand_recurring:
+            items.append({**master, "recurrence": [f"RRULE:FREQ=WEEKLY;COUNT={count}"]})
+            items.extend(exceptions)
+
+    for i in range(scenario.num_events - int(scenario.num_events * scenario.recurring)):
+        items.append(event(f"event{i}", slot(120), "Interview" if i % 10 == 0 else "Meeting"))
+
+    rng.shuffle(items)
+    return items
+
+
+def measure(fn) -> dict:
+    """Runs fn, returning its wall time, number of queries and peak traced memory"""
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            fn()
+            wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"wall": round(wall, 4), "queries": len(queries), "peak_kb": round(peak / 1024)}
+
+
+def run(scenario: Scenario, now: datetime = NOW) -> dict[str, dict]:
+    """Runs a full sync, an incremental sync and every report of a synthetic calendar.
+    Everything is written in a transaction that is rolled back afterwards, so scenarios don't see each other"""
+    rng = random.Random(scenario.seed)
+    with transaction.atomic(), override_settings(
+        AUDIT_INITIAL_SYNC_PAST=None,
+        AUDIT_INITIAL_SYNC_FUTURE=None,
+        AUDIT_EXPAND_RECURRING=scenario.expand_recurring,
+    ):
+        calendar = Calendar.objects.create(email=f"benchmark-{scenario.name}@example.com", timezone="UTC")
+        user = User.objects.create(username=f"benchmark-{scenario.name}", primary_calendar=calendar)
+        user.calendars.add(calendar)
+
+        service = FakeCalendarService(make_items(scenario, calendar.email, now, rng), scenario.page_size)
+        manager = CalendarManager(user, calendar, watch_config=False, service=service)
+
+        results = {"full_sync": measure(manager.sync_events)}
+        service.change(scenario, rng)
+        results["incremental_sync"] = measure(manager.sync_events)
+
+        for name in REPORTS:
+            args = (3,) if name == "get_top_collaborators" else ()
+            report = getattr(ReportBuilder(user, now=now), name)
+            results[name] = measure(lambda: report(*args))
+        cache.clear()
+        builder = ReportBuilder(user, now=now)
+        results["get_report"] = measure(builder.get_report)
+        transaction.set_rollback(True)
+
+    return results
+
+
+def load_baseline() -> dict:
+    return json.loads(BASELINE.read_text())
+
+
+def save_baseline(results: dict[str, dict], tolerance=TOLERANCE) -> None:
+    """Writes the results of every scenario (by name) as the new baseline"""
+    baseline = {
+        "vendor": connection.vendor,
+        "tolerance": tolerance,
+        "scenarios": {
+            name: {"scenario": SCENARIOS[name].as_dict(), "results": scenario_results}
+            for name, scenario_results in results.items()
+        },
+    }
+    BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+
+
+def compare(results: dict[str, dict], expected: dict[str, dict], tolerance: dict) -> list[str]:
+    """Returns a description of every metric that is worse than its baseline by more than the tolerance.
+    The tolerance of a metric is a (factor, slack) pair, anything up to value * factor + slack passes"""
+    regressions = []
+    for benchmark, metrics in expected.items():
+        for metric, value in metrics.items():
+            actual = results[benchmark][metric]
+            factor, slack = tolerance[metric]
+            if actual > value * factor + slack:
+                regressions.append(f"{benchmark} {metric}: {actual}, baseline {value} (x{factor} + {slack})")
+    return regressions
@@ -0,0 +1,55 @@
+"""Micro-benchmark of the event time parsing done by every sync.
+
+    python -m audit.benchmarks.parse [num_events]
+
+Parses the start and end of a synthetic payload of events (100k by default) with utils.to_dt
+and with the strptime + pytz parser it replaced, and prints the per-event cost of each"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+import pytz
+from audit.utils import to_dt
+
+TIMEZONES = ["America/Chicago", "America/New_York", "America/Phoenix", "Europe/London", "UTC"]
+
+
+def legacy_to_dt(time: str, tz: str, as_date=False) -> datetime:
+    """The previous parser, kept for comparison (drops the offset)"""
+    if as_date:
+        s = datetime.strptime(time, "%Y-%m-%d")
+    else:
+        s = datetime.strptime(time[:-6], "%Y-%m-%dT%H:%M:%S")
+    return pytz.timezone(tz).localize(s)
+
+
+def make_payload(num_events: int) -> list[tuple[str, str, str]]:
+    """(start, end, calendar timezone) of num_events timed events spread over a year"""
+    rng = random.Random(0)
+    base = datetime(2022, 1, 1, tzinfo=timezone(timedelta(hours=-6)))
+    payload = []
+    for _ in range(num_events):
+        start = base + timedelta(minutes=15 * rng.randrange(4 * 24 * 365))
+        end = start + timedelta(minutes=30 * rng.randrange(1, 5))
+        payload.append((start.isoformat(), end.isoformat(), rng.choice(TIMEZONES)))
+    return payload
+
+
+def run(parse, payload) -> float:
+    """Seconds per event to parse its start and end"""
+    start = time.perf_counter()
+    for event_start, event_end, tz in payload:
+        parse(event_start, tz=tz)
+        parse(event_end, tz=tz)
+    return (time.perf_counter() - start) / len(payload)
+
+
+def main(num_events=100_000) -> None:
+    payload = make_payload(num_events)
+    print(f"{num_events} events")
+    for name, parse in (("legacy", legacy_to_dt), ("to_dt", to_dt)):
+        print(f"{name:>8}: {run(parse, payload) * 1e6:.2f} us/event")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
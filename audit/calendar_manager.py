@@ -1,24 +1,71 @@
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from .models import Calendar, User, WatchChannel
 from .event_builder import EventBuilder
-from datetime import datetime
+from .instrumentation import span
+from .service_pool import service_pool
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from datetime import datetime, timezone
+from typing import Iterator
+import time
 import uuid
+import logging
 from googleapiclient.errors import HttpError
 
+logger = logging.getLogger(__name__)
+
+
+class SyncStats:
+    """Counters for a single sync, times are in seconds"""
+
+    def __init__(self) -> None:
+        self.pages = 0
+        self.events = 0
+        self.api_time = 0.0
+        self.db_time = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "pages": self.pages,
+            "events": self.events,
+            "api_time": self.api_time,
+            "db_time": self.db_time,
+        }
+
+
+class LoginRequired(Exception):
+    """The user has no credentials that can be refreshed and has to log in again"""
+
 
 class CalendarManager:
     SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
     WATCH_URL = "https://7680-24-121-68-47.ngrok.io/audit/watch/"
-    FIELDS = "items(id,status,summary,eventType,start,end,organizer,attendees(email,responseStatus)),nextPageToken,nextSyncToken"
+    FIELDS = (
+        "items(id,status,summary,eventType,updated,start,end,organizer,attendees(email,responseStatus),"
+        "recurrence,recurringEventId,originalStartTime),nextPageToken,nextSyncToken"
+    )
 
-    def __init__(self, user: User, watch_config=True) -> None:
+    def __init__(
+        self, user: User, calendar: Calendar = None, watch_config=True, interactive=True, service=None
+    ) -> None:
+        """Manages the sync of one of the user's calendars, their primary calendar by default.
+        Without interactive (background and fleet syncs) a user who has to log in again raises
+        LoginRequired instead of blocking on the OAuth flow.
+        A given service (e.g. a fake Calendar API) is used as is, without credentials or the service pool"""
         self.user = user
-        self.creds = self._get_creds()
-        self.service = build("calendar", "v3", credentials=self.creds)
+        self.interactive = interactive
+        self.stats = SyncStats()
+        if service is not None:
+            self.creds, self.service = None, service
+        else:
+            with span("calendar.service", user=user.pk):
+                self.creds, self.service = service_pool.get(user, self._get_creds)
         self.calendar = self._config_user()
+        if calendar:
+            self.calendar = calendar
         if watch_config:
             self._config_watch()
 
@@ -35,6 +82,8 @@ class CalendarManager:
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
+            elif not self.interactive:
+                raise LoginRequired(f"{self.user} has to log in again")
             else:
                 flow = InstalledAppFlow.from_client_secrets_file(
                     "credentials.json", self.SCOPES
@@ -54,102 +103,311 @@ class CalendarManager:
             return self.user.primary_calendar
 
         primary = self.service.calendars().get(calendarId="primary").execute()
-        self.user.primary_calendar, _ = Calendar.objects.get_or_create(
-            email=primary["id"], timezone=primary["timeZone"]
+        # The calendar may already exist from being an attendee/organizer of another user's events
+        self.user.primary_calendar, _ = Calendar.objects.update_or_create(
+            email=primary["id"], defaults={"timezone": primary["timeZone"]}
         )
 
         self.user.save()
+        self.user.calendars.add(self.user.primary_calendar)
 
-        return primary
+        return self.user.primary_calendar
 
+    def sync_calendar_list(self) -> list[Calendar]:
+        """Stores every calendar the user can read (delegated and shared calendars included) and returns them"""
+        calendars = []
+        page_token = None
+        while True:
+            results = (
+                self.service.calendarList()
+                .list(
+                    minAccessRole="reader",
+                    pageToken=page_token,
+                    fields="items(id,timeZone),nextPageToken",
+                )
+                .execute()
+            )
+            for item in results.get("items", []):
+                calendar, _ = Calendar.objects.update_or_create(
+                    email=item["id"], defaults={"timezone": item.get("timeZone")}
+                )
+                calendars.append(calendar)
+
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+        self.user.calendars.add(*calendars)
+        return calendars
+
+    @span("calendar.watch")
     def _config_watch(self):
-        """Checks if the watch channel for the users Primary Calendar exists and is valid,
+        """Checks if the watch channel for the calendar exists and is valid,
         otherwise creates a new watch channel
         """
 
         try:
-            channel = self.user.primary_calendar.channel
+            channel = self.calendar.channel
         except WatchChannel.DoesNotExist:
             pass
         else:
             if channel.is_valid():
                 return
-            # Delete channel if it is expired
-            channel.delete()
 
+        # An expired channel is replaced
         self._start_watch()
 
-    def sync_events(self, full_sync=False):
+    def sync_events(self, full_sync=False, first_page: dict = None, backfill=False) -> bool:
         """Sync local db with Calendar API
         Incrementally saves events unless full_sync is set to true
-        or this is the first sync for the user"""
+        or this is the first sync for the user.
+        first_page can hold the already fetched response to the first list request (e.g. from a batch),
+        with backfill the history left out by a windowed initial sync is fetched afterwards.
+        An interrupted sync resumes from its last checkpointed page.
+        Returns False without syncing if another process is already syncing the calendar"""
+        if not self.claim():
+            logger.info("Skipping sync of %s, it is being synced elsewhere", self.calendar)
+            return False
+        try:
+            self._sync(full_sync, first_page, backfill)
+        finally:
+            self.release()
+        return True
+
+    def claim(self) -> bool:
+        """Claims the calendar for this sync, False if another live sync holds it"""
+        now = datetime.now(timezone.utc)
+        stale = now - settings.AUDIT_SYNC_CLAIM_TIMEOUT
+        claimed = (
+            Calendar.objects.filter(pk=self.calendar.pk)
+            .filter(Q(syncing_since__isnull=True) | Q(syncing_since__lt=stale))
+            .update(syncing_since=now)
+        )
+        if claimed:
+            self.calendar.syncing_since = now
+        return bool(claimed)
+
+    def release(self) -> None:
+        # Only the claim this sync holds, it may have been taken over after going stale
+        Calendar.objects.filter(pk=self.calendar.pk, syncing_since=self.calendar.syncing_since).update(
+            syncing_since=None
+        )
+        self.calendar.syncing_since = None
+
+    def _sync(self, full_sync=False, first_page: dict = None, backfill=False) -> None:
         cal = self.calendar
 
         if full_sync:
-            cal.sync_token = None
-            cal.save()
-            cal.events.all().delete()
+            first_page = None
+            with transaction.atomic():
+                cal.sync_token = None
+                cal.page_token = None
+                cal.synced_events = 0
+                cal.resyncing = False
+                cal.save()
+                # Events shared with other calendars are only unlinked from this one
+                EventBuilder(self.user, cal).clear()
+        elif cal.resyncing and (cal.page_token or cal.sync_token):
+            # The events an interrupted re-sync had seen aren't kept, so it has to start over
+            first_page = None
+            self._start_resync()
+        elif cal.page_token:
+            logger.info("Resuming sync of %s after %d events", cal, cal.synced_events)
+
+        if first_page is None:
+            # A given first page was listed with the window its caller already picked
+            self.prepare_sync()
+        builder = EventBuilder(self.user, cal)
+        seen = set()
         try:
-            events = self._get_events()
+            # Each page is persisted as soon as it arrives
+            for events in self._get_events(first_page):
+                seen |= self._save_page(builder, events)
 
         except HttpError as error:
-            # SyncToken is corrupted -> clear db and re-sync
+            # SyncToken has expired -> list the calendar again and diff it against the stored events
             if error.status_code == 410:
-                self.sync_events(full_sync=True)
+                self._start_resync()
+                self._sync(backfill=backfill)
                 return
+            raise
+
+        if cal.resyncing:
+            removed = builder.sweep(seen, cal.synced_from, cal.synced_until)
+            logger.info("Re-sync of %s removed %d events", cal, removed)
+            cal.resyncing = False
+            cal.save(update_fields=["resyncing"])
 
-        EventBuilder(self.user).save_events(events)
+        if backfill and cal.is_windowed():
+            self._backfill(builder)
 
-    def _get_events(self) -> list[dict]:
-        """Return events via sync token"""
+    def _start_resync(self) -> None:
         cal = self.calendar
-        events = []
+        cal.sync_token = None
+        cal.page_token = None
+        cal.synced_events = 0
+        cal.resyncing = True
+        cal.save(update_fields=["sync_token", "page_token", "synced_events", "resyncing"])
+
+    def prepare_sync(self) -> None:
+        """Picks the time window of an initial sync. Only the report window (plus a margin) is
+        fetched up front, the rest of the history is left for a background backfill"""
+        cal = self.calendar
+        # Incremental syncs and resumed initial syncs keep the parameters they started with
+        if cal.sync_token or cal.page_token:
+            return
+
+        now = datetime.now(timezone.utc)
+        past = settings.AUDIT_INITIAL_SYNC_PAST
+        future = settings.AUDIT_INITIAL_SYNC_FUTURE
+        cal.synced_from = now - past if past is not None else None
+        cal.synced_until = now + future if future is not None else None
+        cal.save(update_fields=["synced_from", "synced_until"])
+
+    def list_request(self, page_token: str = None, window: tuple = None):
+        """Builds (without executing) the request for a page of events.
+        Uses the sync token if there is one, otherwise lists the initial sync window.
+        An explicit (time_min, time_max) window lists that range without the sync token"""
+        cal = self.calendar
+        params = {}
+        if window is None and cal.sync_token:
+            params["syncToken"] = cal.sync_token
+        else:
+            # The sync token can't be combined with a time range
+            time_min, time_max = window or (cal.synced_from, cal.synced_until)
+            if time_min:
+                params["timeMin"] = time_min.isoformat()
+            if time_max:
+                params["timeMax"] = time_max.isoformat()
+
+        return self.service.events().list(
+            calendarId=cal.email,
+            maxResults=2500,
+            singleEvents=settings.AUDIT_EXPAND_RECURRING,
+            pageToken=page_token,
+            fields=self.FIELDS,
+            **params,
+        )
+
+    def _save_page(self, builder: EventBuilder, events: list[dict]) -> set[int]:
+        start = time.perf_counter()
+        seen = builder.save_events(events)
+        self.stats.db_time += time.perf_counter() - start
+        self.stats.events += len(events)
+        return seen
+
+    def _backfill(self, builder: EventBuilder) -> None:
+        """Fetches the history before and after the window of the initial sync.
+        Later changes to these events are already covered by the sync token,
+        stored events in the ranges that are no longer listed (e.g. after a re-sync) are removed"""
+        cal = self.calendar
+        if cal.synced_from:
+            seen = set()
+            for events in self._list_window((None, cal.synced_from)):
+                seen |= self._save_page(builder, events)
+            builder.sweep(seen, time_max=cal.synced_from)
+            cal.synced_from = None
+            cal.save(update_fields=["synced_from"])
+
+        if cal.synced_until:
+            seen = set()
+            for events in self._list_window((cal.synced_until, None)):
+                seen |= self._save_page(builder, events)
+            builder.sweep(seen, time_min=cal.synced_until)
+            cal.synced_until = None
+            cal.save(update_fields=["synced_until"])
+
+    def _list_window(self, window: tuple) -> Iterator[list[dict]]:
+        """Yield each page of events in the (time_min, time_max) window"""
         page_token = None
+        while True:
+            start = time.perf_counter()
+            with span("calendar.list_page", calendar=self.calendar.email):
+                results = self.list_request(page_token, window=window).execute()
+            self.stats.api_time += time.perf_counter() - start
+            self.stats.pages += 1
+            yield results.get("items", [])
+            self._checkpoint()
+
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                break
+
+    def _get_events(self, first_page: dict = None) -> Iterator[list[dict]]:
+        """Yield each page of events via sync token
+        The page token and the number of events persisted so far are checkpointed once a page has been handled
+        so an interrupted sync can resume from it, the nextSyncToken is only saved after the final page has been handled"""
+        cal = self.calendar
+        page_token = cal.page_token
+        results = first_page
         # Loop through all pages of sync until nextPageToken is empty
         while True:
-            results = (
-                self.service.events()
-                .list(
-                    calendarId="primary",
-                    maxResults=2500,
-                    singleEvents=True,
-                    syncToken=cal.sync_token,
-                    pageToken=page_token,
-                    fields=self.FIELDS,
-                )
-                .execute()
-            )
-            events.extend(results.get("items", []))
+            if results is None:
+                start = time.perf_counter()
+                with span("calendar.list_page", calendar=cal.email):
+                    results = self.list_request(page_token).execute()
+                self.stats.api_time += time.perf_counter() - start
+            self.stats.pages += 1
+            items = results.get("items", [])
+            yield items
+
             page_token = results.get("nextPageToken")
+            cal.page_token = page_token
             if not page_token:
                 cal.sync_token = results.get("nextSyncToken")
-                cal.save()
+                cal.last_synced = datetime.now(timezone.utc)
+                cal.synced_events = 0
+                cal.save(update_fields=["sync_token", "page_token", "last_synced", "synced_events"])
                 break
+            cal.synced_events += len(items)
+            self._checkpoint("page_token", "synced_events")
+            results = None
 
-        return events
+    def _checkpoint(self, *fields) -> None:
+        """Saves the given fields once a page has been handled, refreshing the claim on the calendar with them"""
+        cal = self.calendar
+        update_fields = list(fields)
+        if cal.syncing_since:
+            # Keeps the claim alive for as long as pages keep coming
+            cal.syncing_since = datetime.now(timezone.utc)
+            update_fields.append("syncing_since")
+        if update_fields:
+            cal.save(update_fields=update_fields)
 
     def _start_watch(self):
+        channel_id = uuid.uuid1()
+        results = self.watch_request(channel_id).execute()
+        self.replace_channel(channel_id, results)
 
-        calendar = self.user.primary_calendar
-        address = self.WATCH_URL
-        id = uuid.uuid1()
+    def watch_request(self, channel_id: uuid.UUID):
+        """Builds (without executing) the request that starts a watch channel on the calendar"""
+        calendar = self.calendar
         body = {
-            "id": str(id),
+            "id": str(channel_id),
             "type": "webhook",
-            "address": address,
+            "address": self.WATCH_URL,
             "token": calendar.email,
         }
-        results = (
-            self.service.events().watch(calendarId=calendar.email, body=body).execute()
-        )
-        resource_id = results.get("resourceId")
+        return self.service.events().watch(calendarId=calendar.email, body=body)
+
+    def replace_channel(self, channel_id: uuid.UUID, results: dict) -> WatchChannel:
+        """Stores the channel started with channel_id as the calendar's watch channel.
+        Returns the channel it replaced (if any), its notifications are dropped from then on
+        but it keeps running on Google's side until it is stopped or expires"""
         expiration = int(results.get("expiration")) // 1000  # Convert to seconds
-        channel = WatchChannel.objects.create(
-            id=id,
-            resource_id=resource_id,
-            expiration=datetime.fromtimestamp(expiration),
-            calendar=calendar,
-        )
+        with transaction.atomic():
+            # A calendar has a single channel, so the old row has to go before the new one is added
+            old = WatchChannel.objects.select_for_update().filter(calendar=self.calendar).first()
+            if old:
+                # Deleting through the queryset keeps the instance's id for stopping the channel
+                WatchChannel.objects.filter(pk=old.pk).delete()
+            WatchChannel.objects.create(
+                id=channel_id,
+                resource_id=results.get("resourceId"),
+                expiration=datetime.fromtimestamp(expiration, timezone.utc),
+                calendar=self.calendar,
+            )
+        return old
 
     def stop_watch(self, channel_id=None, resource_id=None):
         body = {
@@ -1,93 +1,340 @@
 import audit.utils as utils
+from .instrumentation import span
 from .models import Calendar, Event, Attendee, User
+from .rollups import RollupDelta
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.db import transaction
+from django.db.models import F
 
 
 class EventBuilder:
-    def __init__(self, user: User) -> None:
-        self.calendar = user.primary_calendar
-
-    def save_events(self, events_list: list[dict]) -> None:
-        for event_data in events_list:
-            event = Event()
-            g_id = event_data["id"]
-            status = event_data["status"]
-            if Event.objects.filter(google_id=g_id).exists():
-                event = Event.objects.get(google_id=g_id)
-
-                # The event has been deleted and should be removed from the db
-                if status == "cancelled":
-                    event.delete()
-                    continue
+    EVENT_FIELDS = [
+        "google_id", "status", "summary", "event_type", "all_day", "start", "duration", "organizer", "updated",
+        "recurrence", "recurring_event_id", "original_start",
+    ]
 
-                # If it doesn't exist for this user -> add it
-                if event.calendars.filter(email=self.calendar.email).exists():
-                    event.calendars.add(self.calendar)
-                    continue
-                
-            if status == "cancelled":
+    def __init__(self, user: User, calendar: Calendar = None) -> None:
+        self.calendar = calendar or user.primary_calendar
+        self.calendars = CalendarResolver([self.calendar])
+        # Without expansion the masters are stored, so cancelled exceptions have to be kept to skip their occurrences
+        self.keep_exceptions = not settings.AUDIT_EXPAND_RECURRING
+
+    @span("events.save_page")
+    @transaction.atomic
+    def save_events(self, events_list: list[dict]) -> set[int]:
+        """Saves a page of events from the Calendar API in a single transaction.
+        Existing events are prefetched in one query and writes are applied in bulk,
+        so the number of queries per page does not grow with the number of events.
+        Events are identified by (google_id, organizer) and shared between calendars,
+        an unchanged event that is already stored from another calendar is only linked to this one.
+        Returns the ids of the page's events that are on this calendar"""
+        # Later entries win if the same event shows up twice in a page
+        events_data = {str(event_data["id"]): event_data for event_data in events_list}
+        if not events_data:
+            return set()
+
+        self.calendars.resolve(self._collect_emails(events_data.values()))
+        stored = defaultdict(list)
+        for event in Event.objects.filter(google_id__in=events_data.keys()):
+            stored[event.google_id].append(event)
+        stored_events = [event for events in stored.values() for event in events]
+        links = self._get_calendar_links(stored_events)
+        stored_attendees = list(Attendee.objects.filter(event__in=stored_events)) if stored_events else []
+        attendance = defaultdict(set)
+        for attendee in stored_attendees:
+            attendance[attendee.event_id].add(attendee.calendar_id)
+        masters = self._get_master_organizers(events_data) if self.keep_exceptions else {}
+        rollups = RollupDelta({self.calendar.pk: self.calendar.timezone})
+
+        to_unlink = []
+        to_link = []
+        to_create = []
+        to_update = []
+        unchanged = []
+        for g_id, event_data in events_data.items():
+            is_exception = self.keep_exceptions and "recurringEventId" in event_data
+            # The event has been deleted (or removed from this calendar) and should be removed from it
+            if event_data["status"] == "cancelled" and not is_exception:
+                # Cancellations don't always include the organizer, so every copy on this calendar is removed
+                for event in stored[g_id]:
+                    if self.calendar.pk in links[event.pk]:
+                        to_unlink.append(event)
+                        rollups.add(event, [self.calendar.pk], sign=-1, attendees=attendance[event.pk])
                 continue
-            self.save_event(event_data, base_event=event)
 
+            if "organizer" in event_data:
+                organizer = self.calendars[event_data["organizer"]["email"]]
+            else:
+                # Cancelled exceptions only carry their id, recurringEventId and originalStartTime
+                organizer = masters.get(event_data["recurringEventId"], self.calendar)
+            event = next((e for e in stored[g_id] if e.organizer_id == organizer.pk), None)
+            if not event:
+                # The event changed owner, the copy stored under its old organizer is replaced by this one
+                for old in stored[g_id]:
+                    if self.calendar.pk in links[old.pk]:
+                        to_unlink.append(old)
+                        rollups.add(old, [self.calendar.pk], sign=-1, attendees=attendance[old.pk])
+
+            if event and not self._is_newer(event_data, event):
+                # Already stored (e.g. from another calendar) and unchanged since
+                if self.calendar.pk not in links[event.pk]:
+                    to_link.append(event)
+                    rollups.add(event, [self.calendar.pk], attendees=attendance[event.pk])
+                else:
+                    unchanged.append(event)
+                continue
+
+            if event:
+                # Take the stored version of the event out of the rollups, the new version is added back below
+                rollups.add(event, links[event.pk], sign=-1, attendees=attendance[event.pk])
+                to_update.append(event)
+            else:
+                event = Event()
+                to_create.append(event)
+            self._set_event_fields(event, event_data, organizer)
+            attendees = {self.calendars[a["email"]].pk for a in event_data.get("attendees", [])}
+            rollups.add(event, links[event.pk] | {self.calendar.pk}, attendees=attendees)
+
+        if to_unlink:
+            with span("events.delete", events=len(to_unlink)):
+                self._remove_calendar([event.pk for event in to_unlink])
+        if to_create:
+            with span("events.create", events=len(to_create)):
+                Event.objects.bulk_create(to_create)
+        if to_update:
+            with span("events.update", events=len(to_update)):
+                Event.objects.bulk_update(to_update, self.EVENT_FIELDS)
+
+        rollups.apply()
+
+        saved = to_create + to_update
+        if to_unlink or to_link or saved:
+            self._bump_data_version(to_update, links)
+        if to_link or saved:
+            self._add_calendar(to_link + saved)
+        if saved:
+            with span("events.attendees", events=len(saved)):
+                updated_ids = {event.pk for event in to_update}
+                existing = [attendee for attendee in stored_attendees if attendee.event_id in updated_ids]
+                self._set_event_attendees(saved, events_data, existing)
+
+        return {event.pk for event in to_link + saved + unchanged}
 
     @transaction.atomic
-    def save_event(self, event_data: dict, base_event: Event = None) -> None:
-        '''Saves an event from the given event data. Can also take an existing event to update'''
-        event = Event()
-        if base_event:
-            event = base_event
+    def clear(self) -> None:
+        """Removes every event from this calendar"""
+        self._remove_events(list(self.calendar.events.values_list("pk", flat=True)))
 
-        event.google_id = event_data.get("id")
+    @transaction.atomic
+    def sweep(self, seen: set[int], time_min=None, time_max=None) -> int:
+        """Removes the events of this calendar starting between time_min and time_max (either may be open)
+        that a complete listing of that range didn't return, returns how many were removed"""
+        events = self.calendar.events.all()
+        if time_min:
+            events = events.filter(start__gte=time_min)
+        if time_max:
+            events = events.filter(start__lt=time_max)
+
+        missing = set(events.values_list("pk", flat=True)) - seen
+        if missing:
+            self._remove_events(list(missing))
+        return len(missing)
+
+    def save_event(self, event_data: dict) -> None:
+        """Saves (or updates) a single event from the given event data"""
+        self.save_events([event_data])
+
+    def _collect_emails(self, events_data) -> set[str]:
+        """Returns every organizer and attendee email referenced by the events"""
+        emails = set()
+        for event_data in events_data:
+            # Cancelled events are only unlinked, but cancelled exceptions are stored when they're kept
+            if event_data["status"] == "cancelled" and not (
+                self.keep_exceptions and "recurringEventId" in event_data
+            ):
+                continue
+            organizer = event_data.get("organizer")
+            if organizer:
+                emails.add(organizer["email"])
+            emails.update(attendee["email"] for attendee in event_data.get("attendees", []))
+        return emails
+
+    def _set_event_fields(self, event: Event, event_data: dict, organizer: Calendar) -> None:
+        event.google_id = str(event_data.get("id"))
         event.status = event_data.get("status")
         event.summary = event_data.get("summary")
-        event.event_type = event_data.get("eventType")
+        event.event_type = event_data.get("eventType", "default")
+        event.updated = utils.from_rfc3339(event_data["updated"]) if "updated" in event_data else None
+        event.organizer = organizer
+        event.recurrence = event_data.get("recurrence")
+        event.recurring_event_id = event_data.get("recurringEventId")
+        original = event_data.get("originalStartTime")
+        event.original_start = self._to_dt(original) if original else None
         self._set_event_times(event, event_data)
-        self._set_event_organizer(event, event_data.get("organizer", None))
 
-        # Save before adding many-many
-        event.save()
+    def _set_event_times(self, event: Event, event_data: dict) -> None:
+        if "start" not in event_data:
+            # A cancelled exception only takes up the slot of the occurrence it cancels
+            event.all_day = "date" in event_data["originalStartTime"]
+            event.start = event.original_start
+            event.duration = timedelta()
+            return
 
-        # Only add to event if not already added (for overwriting purposes)
-        if not event.calendars.filter(pk=self.calendar.pk).exists():
-            event.calendars.add(self.calendar)
+        event.all_day = "dateTime" not in event_data["start"]
+        event.start = self._to_dt(event_data["start"])
+        event.duration = self._to_dt(event_data["end"]) - event.start
 
-        self._set_event_attendees(event, event_data.get("attendees", []))
+    def _to_dt(self, time: dict) -> datetime:
+        """Converts an event time (a dateTime or, for all day events, a date) to a datetime"""
+        tz = self.calendar.timezone or "UTC"
+        if "dateTime" in time:
+            return utils.to_dt(time["dateTime"], tz=tz)
+        return utils.to_dt(time["date"], tz=tz, as_date=True)
 
-    def _set_event_times(self, event: Event, event_data: dict) -> None:
-        start = end = None
-        as_date = False
-        tz = self.calendar.timezone
-        if "dateTime" in event_data["start"]:
-            start = event_data["start"]["dateTime"]
-            end = event_data["end"]["dateTime"]
-            event.all_day = False
-        else:
-            start = event_data["start"]["date"]
-            end = event_data["end"]["date"]
-            as_date = True
-            event.all_day = True
-
-        start = utils.to_dt(start, tz=tz, as_date=as_date)
-        end = utils.to_dt(end, tz=tz, as_date=as_date)
-
-        event.start = start
-        event.duration = end - start
-
-    def _set_event_organizer(self, event: Event, organizer: dict) -> None:
-        if organizer:
-            event.organizer, _ = Calendar.objects.get_or_create(email=organizer["email"])
-
-    def _set_event_attendees(self, event: Event, attendees: dict) -> None:
-        if not attendees:
-            return
-        to_set = []
-    
-        for attendee in attendees:
-            calendar, _ = Calendar.objects.get_or_create(email=attendee["email"])
-            to_set.append(
-                Attendee(calendar=calendar, response_status=attendee["responseStatus"])
+    def _get_master_organizers(self, events_data: dict) -> dict[str, Calendar]:
+        """Returns the organizer of the recurring masters of the cancelled exceptions in the page"""
+        master_ids = {
+            data["recurringEventId"]
+            for data in events_data.values()
+            if "recurringEventId" in data and "organizer" not in data
+        }
+        organizers = {}
+        for master_id in master_ids:
+            master = events_data.get(master_id)
+            if master and "organizer" in master:
+                organizers[master_id] = self.calendars[master["organizer"]["email"]]
+
+        missing = master_ids - organizers.keys()
+        if missing:
+            for master in Event.objects.filter(
+                google_id__in=missing, calendars=self.calendar, recurrence__isnull=False
+            ).select_related("organizer"):
+                organizers[master.google_id] = master.organizer
+        return organizers
+
+    def _is_newer(self, event_data: dict, event: Event) -> bool:
+        """True if the event data holds changes that haven't been stored yet"""
+        if not event.updated or "updated" not in event_data:
+            return True
+        return utils.from_rfc3339(event_data["updated"]) > event.updated
+
+    def _bump_data_version(self, updated: list[Event], links) -> None:
+        """Invalidates the cached reports of this calendar and of every calendar the updated events are linked to"""
+        calendar_ids = {self.calendar.pk}
+        for event in updated:
+            calendar_ids |= links[event.pk]
+        Calendar.objects.filter(pk__in=calendar_ids).update(data_version=F("data_version") + 1)
+
+    def _get_calendar_links(self, events) -> defaultdict[int, set]:
+        """Returns the ids of the calendars each of the events is linked to"""
+        links = defaultdict(set)
+        if not events:
+            return links
+
+        through = Event.calendars.through
+        for event_id, calendar_id in through.objects.filter(event__in=events).values_list(
+            "event_id", "calendar_id"
+        ):
+            links[event_id].add(calendar_id)
+        return links
+
+    def _remove_events(self, event_ids: list[int]) -> None:
+        """Takes the events out of this calendar's rollups and unlinks them"""
+        rollups = RollupDelta({self.calendar.pk: self.calendar.timezone})
+        rollups.remove_events(Event.objects.filter(pk__in=event_ids), calendar_ids=[self.calendar.pk])
+        rollups.apply()
+        self._remove_calendar(event_ids)
+        self._bump_data_version([], {})
+
+    def _remove_calendar(self, event_ids: list[int]) -> None:
+        """Unlinks the events from this calendar, deleting the ones no other calendar holds anymore"""
+        through = Event.calendars.through
+        through.objects.filter(event_id__in=event_ids, calendar_id=self.calendar.pk).delete()
+        Event.objects.filter(pk__in=event_ids, calendars__isnull=True).delete()
+
+    def _add_calendar(self, events: list[Event]) -> None:
+        """Links the events to this calendar, skipping any links that already exist"""
+        through = Event.calendars.through
+        links = [through(event_id=event.pk, calendar_id=self.calendar.pk) for event in events]
+        through.objects.bulk_create(links, ignore_conflicts=True)
+
+    def _set_event_attendees(self, events: list[Event], events_data: dict, existing: list[Attendee]) -> None:
+        """Diffs the attendees of the events against the existing (stored) attendees.
+        Only changed response statuses are updated, new attendees are inserted and removed ones deleted"""
+        to_create = []
+        to_update = []
+        to_delete = []
+
+        stored = {}
+        for attendee in existing:
+            current = stored.setdefault(attendee.event_id, {})
+            # Duplicate rows can be left over from the old delete-and-reinsert writes
+            if attendee.calendar_id in current:
+                to_delete.append(attendee.pk)
+                continue
+            current[attendee.calendar_id] = attendee
+
+        for event in events:
+            current = stored.get(event.pk, {})
+            seen = set()
+            for attendee_data in events_data[event.google_id].get("attendees", []):
+                calendar = self.calendars[attendee_data["email"]]
+                if calendar.pk in seen:
+                    continue
+                seen.add(calendar.pk)
+
+                status = attendee_data["responseStatus"]
+                attendee = current.get(calendar.pk)
+                if attendee is None:
+                    to_create.append(Attendee(event=event, calendar=calendar, response_status=status))
+                elif attendee.response_status != status:
+                    attendee.response_status = status
+                    to_update.append(attendee)
+
+            to_delete.extend(
+                attendee.pk for calendar_id, attendee in current.items() if calendar_id not in seen
             )
-        
-        # If overwriting, all the intermediary models need to be deleted and re-added
-        event.attendance.all().delete()
-        event.attendance.set(to_set, bulk=False)
+
+        if to_delete:
+            Attendee.objects.filter(pk__in=to_delete).delete()
+        if to_create:
+            Attendee.objects.bulk_create(to_create)
+        if to_update:
+            Attendee.objects.bulk_update(to_update, ["response_status"])
+
+
+class CalendarResolver:
+    """Email -> Calendar lookup shared across the pages of a sync.
+    Unknown emails are fetched with one query and any missing Calendars are inserted in bulk,
+    after which lookups are served from memory"""
+
+    def __init__(self, calendars: list[Calendar] = None) -> None:
+        self._calendars = {calendar.email: calendar for calendar in calendars or []}
+
+    def __getitem__(self, email: str) -> Calendar:
+        return self._calendars[email]
+
+    def resolve(self, emails: set[str]) -> None:
+        """Loads (or creates) the Calendars for all of the given emails"""
+        missing = set(emails) - self._calendars.keys()
+        if not missing:
+            return
+
+        self._load(missing)
+        missing -= self._calendars.keys()
+        if not missing:
+            return
+
+        # Another sync may have inserted some of these in the meantime, the unique
+        # constraint on email makes ignore_conflicts skip them safely
+        Calendar.objects.bulk_create(
+            [Calendar(email=email) for email in missing], ignore_conflicts=True
+        )
+        # ignore_conflicts doesn't return primary keys so the new rows are re-read
+        self._load(missing)
+
+    def _load(self, emails: set[str]) -> None:
+        for calendar in Calendar.objects.filter(email__in=emails):
+            self._calendars[calendar.email] = calendar
@@ -0,0 +1,258 @@
+import logging
+import multiprocessing
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import django
+from django.db import close_old_connections, connection, connections
+from googleapiclient.errors import HttpError
+from .calendar_manager import CalendarManager, SyncStats
+from .models import Calendar, User, WatchChannel
+
+logger = logging.getLogger(__name__)
+
+
+def is_rate_limited(error: HttpError) -> bool:
+    """True if the Calendar API rejected the request for going over a quota"""
+    if error.status_code == 429:
+        return True
+    if error.status_code != 403:
+        return False
+    reasons = {detail.get("reason") for detail in error.error_details or [] if isinstance(detail, dict)}
+    return bool(reasons & {"rateLimitExceeded", "userRateLimitExceeded"})
+
+
+def sync_with_backoff(
+    manager: CalendarManager, full_sync=False, first_page: dict = None, max_retries=5, backfill=True
+) -> None:
+    """Runs the manager's sync, retrying with exponential back-off while it is rate limited"""
+    for attempt in range(max_retries + 1):
+        try:
+            manager.sync_events(full_sync=full_sync, first_page=first_page, backfill=backfill)
+            return
+        except HttpError as error:
+            if not is_rate_limited(error) or attempt == max_retries:
+                raise
+            # The retry resumes from the last saved page
+            first_page = None
+            time.sleep(2**attempt + random.random())
+
+
+def _sync_in_process(user_pk: int, calendar_pk: int, full_sync: bool, max_retries: int) -> SyncStats:
+    """Worker for the process pool, each process has its own db connection"""
+    close_old_connections()
+    try:
+        user = User.objects.get(pk=user_pk)
+        calendar = Calendar.objects.get(pk=calendar_pk) if calendar_pk else None
+        manager = CalendarManager(user, calendar=calendar, watch_config=False, interactive=False)
+        sync_with_backoff(manager, full_sync=full_sync, max_retries=max_retries)
+        return manager.stats
+    finally:
+        connection.close()
+
+
+class FleetSync:
+    """Syncs the primary (or with all_calendars, every readable) calendar of many users.
+    With a thread pool the first page of every user's sync is fetched with Calendar API batch requests
+    and the remaining pages are fetched concurrently by the workers. With a process pool every user
+    is synced independently in a worker process"""
+
+    # The Calendar API accepts at most 50 calls per batch
+    BATCH_SIZE = 50
+
+    def __init__(
+        self, users, max_workers=8, max_retries=5, full_sync=False, use_processes=False, all_calendars=False
+    ) -> None:
+        self.users = list(users)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.full_sync = full_sync
+        self.use_processes = use_processes
+        self.all_calendars = all_calendars
+        # Both are keyed by (user, calendar), the calendar is None if the user couldn't be set up
+        self.stats = {}
+        self.errors = {}
+
+    def run(self) -> dict[tuple[User, Calendar], Exception]:
+        """Syncs every calendar, returning the errors of the ones whose sync failed.
+        The stats of the calendars that synced are left in self.stats"""
+        if self.use_processes:
+            self._run_processes()
+        else:
+            self._run_threads()
+        return self.errors
+
+    def _run_threads(self) -> None:
+        managers = self._build_managers()
+
+        first_pages = {}
+        if not self.full_sync:
+            for start in range(0, len(managers), self.BATCH_SIZE):
+                first_pages.update(self._fetch_first_pages(managers, start))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fleet-sync") as pool:
+            for i, manager in enumerate(managers):
+                pool.submit(self._sync, manager, first_pages.get(i))
+
+    def _run_processes(self) -> None:
+        # Children must open their own connections rather than share the parent's
+        connections.close_all()
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=context, initializer=django.setup
+        ) as pool:
+            futures = {}
+            # A calendar shared between users is synced once, with whichever reader comes first
+            seen = set()
+            for user in self.users:
+                calendars = [user.primary_calendar]
+                if self.all_calendars:
+                    calendars = list(user.calendars.all()) or calendars
+                for calendar in calendars:
+                    if calendar:
+                        if calendar.pk in seen:
+                            continue
+                        seen.add(calendar.pk)
+                    futures[(user, calendar)] = pool.submit(
+                        _sync_in_process,
+                        user.pk,
+                        calendar.pk if calendar else None,
+                        self.full_sync,
+                        self.max_retries,
+                    )
+
+            for key, future in futures.items():
+                try:
+                    self.stats[key] = future.result()
+                except Exception as error:
+                    logger.warning("Sync failed for %s: %s", key, error)
+                    self.errors[key] = error
+
+    def _build_managers(self) -> list[CalendarManager]:
+        """One manager per calendar. Concurrent syncs of the same calendar would overwrite each other's
+        tokens and checkpoints, so a calendar shared between users is synced with its first reader"""
+        managers = []
+        seen = set()
+        for user in self.users:
+            try:
+                manager = CalendarManager(user, watch_config=False, interactive=False)
+                if manager.calendar.pk not in seen:
+                    seen.add(manager.calendar.pk)
+                    managers.append(manager)
+                if self.all_calendars:
+                    for calendar in manager.sync_calendar_list():
+                        if calendar.pk not in seen:
+                            seen.add(calendar.pk)
+                            managers.append(
+                                CalendarManager(user, calendar=calendar, watch_config=False, interactive=False)
+                            )
+            except Exception as error:
+                # A revoked or broken token only takes out its own user
+                logger.warning("Could not set up sync for %s: %s", user, error)
+                self.errors[(user, None)] = error
+        return managers
+
+    def _fetch_first_pages(self, managers: list[CalendarManager], start: int) -> dict[int, dict]:
+        """Fetches the first page of the sync of the next BATCH_SIZE managers in a single batch request.
+        Calls that fail are left out so the worker fetches them again (with back-off)"""
+        managers = managers[start : start + self.BATCH_SIZE]
+        pages = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                pages[int(request_id)] = response
+
+        batch = managers[0].service.new_batch_http_request(callback=callback)
+        for i, manager in enumerate(managers, start):
+            manager.prepare_sync()
+            batch.add(manager.list_request(manager.calendar.page_token), request_id=str(i))
+
+        batch_start = time.perf_counter()
+        try:
+            batch.execute()
+        except HttpError as error:
+            logger.warning("Batch request failed, falling back to individual requests: %s", error)
+
+        # Every call in the batch waited on the same round trip
+        elapsed = time.perf_counter() - batch_start
+        for manager in managers:
+            manager.stats.api_time += elapsed
+        return pages
+
+    def _sync(self, manager: CalendarManager, first_page: dict = None) -> None:
+        close_old_connections()
+        try:
+            sync_with_backoff(
+                manager, full_sync=self.full_sync, first_page=first_page, max_retries=self.max_retries
+            )
+            self.stats[(manager.user, manager.calendar)] = manager.stats
+        except Exception as error:
+            logger.exception("Sync failed for %s (%s)", manager.user, manager.calendar)
+            self.errors[(manager.user, manager.calendar)] = error
+        finally:
+            connection.close()
+
+
+def renew_watches(horizon: timedelta, batch_size=FleetSync.BATCH_SIZE) -> tuple[int, dict]:
+    """Replaces every watch channel expiring within the horizon, so push notifications never lapse.
+    The new channels are started with batch requests and swapped in before the superseded ones are stopped.
+    Returns the number of renewed channels and the errors of the calendars that couldn't be renewed"""
+    cutoff = datetime.now(timezone.utc) + horizon
+    channels = (
+        WatchChannel.objects.filter(expiration__lt=cutoff, calendar__isnull=False)
+        .select_related("calendar")
+        .prefetch_related("calendar__readers")
+    )
+
+    errors = {}
+    managers = []
+    for channel in channels:
+        calendar = channel.calendar
+        user = next(iter(calendar.readers.all()), None)
+        if user is None:
+            # Nobody reads the calendar anymore, let the channel run out
+            continue
+        try:
+            managers.append(CalendarManager(user, calendar=calendar, watch_config=False, interactive=False))
+        except Exception as error:
+            logger.warning("Could not set up watch renewal for %s: %s", calendar, error)
+            errors[calendar] = error
+
+    renewed = 0
+    for start in range(0, len(managers), batch_size):
+        renewed += _renew_batch(managers[start : start + batch_size], errors)
+    return renewed, errors
+
+
+def _renew_batch(managers: list[CalendarManager], errors: dict) -> int:
+    started = {}
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            started[int(request_id)] = response
+        else:
+            errors[managers[int(request_id)].calendar] = exception
+
+    channel_ids = [uuid.uuid1() for _ in managers]
+    batch = managers[0].service.new_batch_http_request(callback=callback)
+    for i, (manager, channel_id) in enumerate(zip(managers, channel_ids)):
+        batch.add(manager.watch_request(channel_id), request_id=str(i))
+    try:
+        batch.execute()
+    except HttpError as error:
+        logger.warning("Watch renewal batch failed: %s", error)
+        return 0
+
+    for i, results in started.items():
+        manager = managers[i]
+        old = manager.replace_channel(channel_ids[i], results)
+        if not old:
+            continue
+        try:
+            manager.stop_watch(channel_id=str(old.id), resource_id=old.resource_id)
+        except HttpError as error:
+            # It expires on its own and its notifications are already dropped
+            logger.warning("Could not stop channel %s of %s: %s", old.id, manager.calendar, error)
+    return len(started)
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """A finished span: its wall time in seconds, the number of db queries it ran and free-form tags"""
+
+    def __init__(self, name: str, duration: float, queries: int, tags: dict) -> None:
+        self.name = name
+        self.duration = duration
+        self.queries = queries
+        self.tags = tags
+
+    def as_dict(self) -> dict:
+        return {"span": self.name, "duration": self.duration, "queries": self.queries, **self.tags}
+
+
+class _QueryCounter:
+    """execute_wrapper counting the queries run on the connection"""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def span(name: str, **tags):
+    """Times the block (or, as a decorator, the function) and counts its db queries.
+    The finished span is passed to the AUDIT_SPAN_HOOK, nested spans count their queries in both"""
+    counter = _QueryCounter()
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(counter):
+            yield
+    finally:
+        get_hook()(Span(name, time.perf_counter() - start, counter.count, tags))
+
+
+def get_hook():
+    return _load_hook(getattr(settings, "AUDIT_SPAN_HOOK", "audit.instrumentation.default_hook"))
+
+
+@lru_cache(maxsize=None)
+def _load_hook(path: str):
+    return import_string(path)
+
+
+class SpanRegistry:
+    """Process-level totals of the finished spans by name, exported in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: [0, 0.0, 0])
+
+    def observe(self, span: Span) -> None:
+        with self._lock:
+            totals = self._totals[span.name]
+            totals[0] += 1
+            totals[1] += span.duration
+            totals[2] += span.queries
+
+    def clear(self) -> None:
+        with self._lock:
+            self._totals.clear()
+
+    def export(self) -> str:
+        with self._lock:
+            totals = sorted((name, list(values)) for name, values in self._totals.items())
+
+        lines = ["# TYPE audit_span_seconds summary"]
+        for name, (count, duration, _) in totals:
+            lines.append(f'audit_span_seconds_count{{span="{name}"}} {count}')
+            lines.append(f'audit_span_seconds_sum{{span="{name}"}} {duration:.6f}')
+        lines.append("# TYPE audit_span_queries counter")
+        for name, (_, _, queries) in totals:
+            lines.append(f'audit_span_queries_total{{span="{name}"}} {queries}')
+        return "\n".join(lines) + "\n"
+
+
+registry = SpanRegistry()
+
+
+def default_hook(span: Span) -> None:
+    """Logs the span as a structured record and adds it to the registry served by the metrics view"""
+    logger.debug(
+        "%s took %.1fms and %d queries", span.name, span.duration * 1000, span.queries, extra=span.as_dict()
+    )
+    registry.observe(span)
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from audit.benchmarks import harness
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks syncing and reporting synthetic calendars against baseline.json, "
+        "every write is rolled back afterwards"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenario", action="append", choices=sorted(harness.SCENARIOS), help="Only run these scenarios"
+        )
+        parser.add_argument("--save", action="store_true", help="Write the results as the new baseline")
+
+    def handle(self, *args, **options):
+        names = options["scenario"] or sorted(harness.SCENARIOS)
+        results = {}
+        for name in names:
+            results[name] = harness.run(harness.SCENARIOS[name])
+
+            for benchmark, metrics in results[name].items():
+                self.stdout.write(
+                    f"{name} {benchmark}: {metrics['wall']:.4f}s, {metrics['queries']} queries, "
+                    f"{metrics['peak_kb']} KiB peak"
+                )
+
+        if options["save"]:
+            harness.save_baseline(results)
+            self.stdout.write(f"Saved baseline to {harness.BASELINE}")
+            return
+
+        baseline = harness.load_baseline()
+        if baseline["vendor"] != connection.vendor:
+            self.stderr.write(f"The baseline was recorded on {baseline['vendor']}, skipping the comparison")
+            return
+
+        regressions = []
+        for name in names:
+            expected = baseline["scenarios"][name]["results"]
+            regressions += [f"{name} {r}" for r in harness.compare(results[name], expected, baseline["tolerance"])]
+        if regressions:
+            raise CommandError("Regressed against the baseline:\n" + "\n".join(regressions))
+        self.stdout.write("No regressions against the baseline")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from audit import snapshot
+
+
+class Command(BaseCommand):
+    help = "Writes a columnar snapshot of the events and attendance for offline analytics"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Directory to write the snapshot to, replacing any snapshot in it")
+        parser.add_argument(
+            "--chunk-size", type=int, default=2000, help="Rows fetched from the database at a time"
+        )
+
+    def handle(self, *args, **options):
+        manifest = snapshot.export(options["path"], chunk_size=options["chunk_size"])
+        rows = ", ".join(f"{count} {table}" for table, count in manifest["rows"].items())
+        self.stdout.write(f"Exported {rows} and {manifest['emails']} emails to {options['path']}")
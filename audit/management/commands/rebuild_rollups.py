@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from audit.models import Calendar
+from audit import rollups
+
+
+class Command(BaseCommand):
+    help = "Recomputes the weekly and monthly rollups and the collaborations from the stored events"
+
+    def add_arguments(self, parser):
+        parser.add_argument("emails", nargs="*", help="Only rebuild these calendars")
+
+    def handle(self, *args, **options):
+        calendars = Calendar.objects.filter(events__isnull=False).distinct()
+        if options["emails"]:
+            calendars = calendars.filter(email__in=options["emails"])
+
+        for calendar in calendars:
+            rollups.rebuild(calendar)
+            self.stdout.write(f"Rebuilt rollups for {calendar}")
@@ -0,0 +1,37 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from audit.fleet import renew_watches
+
+
+class Command(BaseCommand):
+    help = "Renews the watch channels that are about to expire, once or in a loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--horizon",
+            type=float,
+            help="Renew channels expiring within this many hours (default AUDIT_WATCH_RENEWAL_HORIZON)",
+        )
+        parser.add_argument(
+            "--loop", action="store_true", help="Keep running, checking for expiring channels every --interval"
+        )
+        parser.add_argument("--interval", type=int, default=60 * 60, help="Seconds between checks with --loop")
+
+    def handle(self, *args, **options):
+        horizon = settings.AUDIT_WATCH_RENEWAL_HORIZON
+        if options["horizon"] is not None:
+            horizon = timedelta(hours=options["horizon"])
+
+        while True:
+            close_old_connections()
+            renewed, errors = renew_watches(horizon)
+            for calendar, error in errors.items():
+                self.stderr.write(f"{calendar}: {error}")
+            self.stdout.write(f"Renewed {renewed} watch channels, {len(errors)} failed")
+
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,78 @@
+import time
+from datetime import datetime, timezone
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from audit.fleet import FleetSync
+from audit.models import User
+
+
+class Command(BaseCommand):
+    help = "Syncs the calendars of every user (or a filtered set) with the Calendar API"
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="Only sync these users")
+        parser.add_argument("--email", action="append", default=[], help="Only sync these calendars")
+        parser.add_argument(
+            "--stale",
+            action="store_true",
+            help="Only sync calendars whose last sync is older than AUDIT_SYNC_STALENESS",
+        )
+        parser.add_argument("--workers", type=int, default=8, help="Number of concurrent syncs")
+        parser.add_argument(
+            "--processes",
+            action="store_true",
+            help="Sync in a pool of worker processes instead of threads (no batched first pages)",
+        )
+        parser.add_argument(
+            "--full", action="store_true", help="Clear the stored events and do a full sync"
+        )
+        parser.add_argument(
+            "--all-calendars",
+            action="store_true",
+            help="Sync every calendar the users can read instead of only their primary calendars",
+        )
+
+    def handle(self, *args, **options):
+        users = (
+            User.objects.filter(auth_token__isnull=False)
+            .select_related("primary_calendar")
+            .prefetch_related("calendars")
+        )
+        if options["usernames"]:
+            users = users.filter(username__in=options["usernames"])
+        if options["email"]:
+            users = users.filter(primary_calendar__email__in=options["email"])
+        if options["stale"]:
+            cutoff = datetime.now(timezone.utc) - settings.AUDIT_SYNC_STALENESS
+            users = users.filter(
+                Q(primary_calendar__last_synced__isnull=True) | Q(primary_calendar__last_synced__lt=cutoff)
+            )
+        users = list(users)
+
+        fleet = FleetSync(
+            users,
+            max_workers=options["workers"],
+            full_sync=options["full"],
+            use_processes=options["processes"],
+            all_calendars=options["all_calendars"],
+        )
+        start = time.perf_counter()
+        errors = fleet.run()
+        elapsed = time.perf_counter() - start
+
+        for (user, calendar), stats in fleet.stats.items():
+            self.stdout.write(
+                f"{user} ({calendar}): {stats.events} events, {stats.pages} pages, "
+                f"api {stats.api_time:.2f}s, db {stats.db_time:.2f}s"
+            )
+        for (user, calendar), error in errors.items():
+            self.stderr.write(f"{user} ({calendar}): {error}")
+
+        total_events = sum(stats.events for stats in fleet.stats.values())
+        total_pages = sum(stats.pages for stats in fleet.stats.values())
+        throughput = total_events / elapsed if elapsed else 0
+        self.stdout.write(
+            f"Synced {len(fleet.stats)} calendars of {len(users)} users in {elapsed:.2f}s: "
+            f"{total_events} events, {total_pages} pages, {throughput:.1f} events/s"
+        )
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:30
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_calendars(apps, schema_editor):
+    """Points every reference to a duplicated Calendar at the oldest row with that email
+    and deletes the rest so the unique constraint can be added"""
+    Calendar = apps.get_model("audit", "Calendar")
+    Attendee = apps.get_model("audit", "Attendee")
+    Event = apps.get_model("audit", "Event")
+    User = apps.get_model("audit", "User")
+    WatchChannel = apps.get_model("audit", "WatchChannel")
+    EventCalendars = Event.calendars.through
+
+    duplicates = (
+        Calendar.objects.values("email")
+        .annotate(keep=Min("pk"), count=Count("pk"))
+        .filter(count__gt=1)
+    )
+    for dup in duplicates:
+        keep = dup["keep"]
+        others = list(
+            Calendar.objects.filter(email=dup["email"]).exclude(pk=keep).values_list("pk", flat=True)
+        )
+        Attendee.objects.filter(calendar_id__in=others).update(calendar_id=keep)
+        Event.objects.filter(organizer_id__in=others).update(organizer_id=keep)
+
+        linked = EventCalendars.objects.filter(calendar_id=keep).values_list("event_id", flat=True)
+        EventCalendars.objects.filter(calendar_id__in=others, event_id__in=linked).delete()
+        EventCalendars.objects.filter(calendar_id__in=others).update(calendar_id=keep)
+
+        # One-to-one references can only be moved if the kept calendar is free
+        if not User.objects.filter(primary_calendar_id=keep).exists():
+            user = User.objects.filter(primary_calendar_id__in=others).first()
+            if user:
+                User.objects.filter(pk=user.pk).update(primary_calendar_id=keep)
+        User.objects.filter(primary_calendar_id__in=others).update(primary_calendar_id=None)
+        WatchChannel.objects.filter(calendar_id__in=others).delete()
+
+        Calendar.objects.filter(pk__in=others).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0011_remove_event_from_watch"),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_calendars, migrations.RunPython.noop),
+    ]
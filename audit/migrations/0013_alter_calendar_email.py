@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0012_merge_duplicate_calendars"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="calendar",
+            name="email",
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
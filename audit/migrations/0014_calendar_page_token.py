@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0013_alter_calendar_email"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="page_token",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0014_calendar_page_token"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="last_synced",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:34
+
+import datetime
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0015_calendar_last_synced"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonthlyRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("period_start", models.DateField()),
+                ("meeting_count", models.IntegerField(default=0)),
+                ("total_duration", models.DurationField(default=datetime.timedelta)),
+                (
+                    "recruiting_duration",
+                    models.DurationField(default=datetime.timedelta),
+                ),
+                (
+                    "calendar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="audit.calendar"
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("calendar", "period_start"),
+                        name="unique_monthly_rollup",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="WeeklyRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("period_start", models.DateField()),
+                ("meeting_count", models.IntegerField(default=0)),
+                ("total_duration", models.DurationField(default=datetime.timedelta)),
+                (
+                    "recruiting_duration",
+                    models.DurationField(default=datetime.timedelta),
+                ),
+                (
+                    "calendar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="audit.calendar"
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("calendar", "period_start"), name="unique_weekly_rollup"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0016_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="data_version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:34
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_rows(apps, schema_editor):
+    """Removes the duplicate events and attendees left behind by the per-event writes
+    so the unique constraints can be added. The oldest row is kept and takes over
+    the calendars and attendees of the duplicates it replaces"""
+    Event = apps.get_model("audit", "Event")
+    Attendee = apps.get_model("audit", "Attendee")
+    EventCalendars = Event.calendars.through
+
+    duplicates = (
+        Event.objects.values("google_id")
+        .annotate(keep=Min("pk"), count=Count("pk"))
+        .filter(count__gt=1)
+    )
+    for dup in duplicates:
+        keep = dup["keep"]
+        others = list(
+            Event.objects.filter(google_id=dup["google_id"]).exclude(pk=keep).values_list("pk", flat=True)
+        )
+
+        # Several duplicates can be on the same calendar, which can only be linked to the kept event once
+        linked = EventCalendars.objects.filter(event_id=keep).values_list("calendar_id", flat=True)
+        calendar_ids = set(
+            EventCalendars.objects.filter(event_id__in=others)
+            .exclude(calendar_id__in=linked)
+            .values_list("calendar_id", flat=True)
+        )
+        EventCalendars.objects.bulk_create(
+            [EventCalendars(event_id=keep, calendar_id=calendar_id) for calendar_id in calendar_ids]
+        )
+
+        # Likewise the oldest attendee row of each calendar is moved, the rest go with the duplicates
+        attending = Attendee.objects.filter(event_id=keep).values_list("calendar_id", flat=True)
+        moved = (
+            Attendee.objects.filter(event_id__in=others)
+            .exclude(calendar_id__in=attending)
+            .values("calendar_id")
+            .annotate(oldest=Min("pk"))
+            .values_list("oldest", flat=True)
+        )
+        Attendee.objects.filter(pk__in=list(moved)).update(event_id=keep)
+
+        Event.objects.filter(pk__in=others).delete()
+
+    duplicates = (
+        Attendee.objects.values("event_id", "calendar_id")
+        .annotate(keep=Min("pk"), count=Count("pk"))
+        .filter(count__gt=1)
+    )
+    for dup in duplicates:
+        Attendee.objects.filter(event_id=dup["event_id"], calendar_id=dup["calendar_id"]).exclude(
+            pk=dup["keep"]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0017_calendar_data_version"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_rows, migrations.RunPython.noop),
+    ]
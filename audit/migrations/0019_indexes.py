@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0018_remove_duplicate_rows"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="event",
+            name="google_id",
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name="watchchannel",
+            name="expiration",
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name="event",
+            index=models.Index(
+                condition=models.Q(("all_day", False)),
+                fields=["start"],
+                name="event_timed_start_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="event",
+            index=models.Index(
+                fields=["start", "all_day"], name="event_start_all_day_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="attendee",
+            constraint=models.UniqueConstraint(
+                fields=("event", "calendar"), name="unique_attendee"
+            ),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:39
+
+from django.db import migrations, models
+
+
+def add_primary_calendars(apps, schema_editor):
+    User = apps.get_model("audit", "User")
+    for user in User.objects.filter(primary_calendar__isnull=False):
+        user.calendars.add(user.primary_calendar_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0019_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="event",
+            name="updated",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="calendars",
+            field=models.ManyToManyField(
+                blank=True, related_name="readers", to="audit.calendar"
+            ),
+        ),
+        migrations.AlterField(
+            model_name="event",
+            name="google_id",
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AddConstraint(
+            model_name="event",
+            constraint=models.UniqueConstraint(
+                fields=("google_id", "organizer"), name="unique_event"
+            ),
+        ),
+        migrations.RunPython(add_primary_calendars, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0020_shared_events"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="synced_from",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="calendar",
+            name="synced_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
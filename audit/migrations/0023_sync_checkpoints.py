@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0022_event_recurrence"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="resyncing",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="calendar",
+            name="synced_events",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
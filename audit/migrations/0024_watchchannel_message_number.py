@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0023_sync_checkpoints"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="watchchannel",
+            name="message_number",
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,103 @@
+from collections import defaultdict
+from datetime import timedelta
+from zoneinfo import ZoneInfo
+from django.conf import settings
+from django.db import migrations
+from django.db.models import F
+
+# As of this migration, audit.utils.RECRUITING_KEYWORDS
+RECRUITING_KEYWORDS = ["recruiting", "interview"]
+
+
+def rebuild_rollups(apps, schema_editor):
+    """Recomputes the rollups and collaborations of every calendar with events. Fills them for calendars
+    synced before they existed and re-buckets earlier rollups into the calendars' timezones.
+    Same rules as rollups.rebuild at the time, written against the historical models"""
+    Calendar = apps.get_model("audit", "Calendar")
+    Event = apps.get_model("audit", "Event")
+    Attendee = apps.get_model("audit", "Attendee")
+    WeeklyRollup = apps.get_model("audit", "WeeklyRollup")
+    MonthlyRollup = apps.get_model("audit", "MonthlyRollup")
+    Collaboration = apps.get_model("audit", "Collaboration")
+    EventCalendars = Event.calendars.through
+
+    calendars = Calendar.objects.filter(events__isnull=False).distinct()
+    for calendar_id, tz in calendars.values_list("pk", "timezone").iterator():
+        tz = ZoneInfo(tz or settings.TIME_ZONE)
+        event_ids = EventCalendars.objects.filter(calendar_id=calendar_id).values(
+            "event_id"
+        )
+        events = Event.objects.filter(
+            pk__in=event_ids, all_day=False, recurrence__isnull=True
+        ).exclude(status="cancelled")
+        attendees = defaultdict(set)
+        for event_id, attendee_id in Attendee.objects.filter(
+            event__in=events
+        ).values_list("event_id", "calendar_id"):
+            attendees[event_id].add(attendee_id)
+
+        # (model, period start) -> [meetings, duration, recruiting duration]
+        rollups = defaultdict(lambda: [0, timedelta(), timedelta()])
+        # (collaborator id, month) -> meetings
+        collaborations = defaultdict(int)
+        for pk, start, duration, summary in events.values_list(
+            "pk", "start", "duration", "summary"
+        ).iterator():
+            local = start.astimezone(tz).date()
+            month = local.replace(day=1)
+            recruiting = summary and any(
+                kw in summary.lower() for kw in RECRUITING_KEYWORDS
+            )
+            for key in (
+                (WeeklyRollup, local - timedelta(days=local.weekday())),
+                (MonthlyRollup, month),
+            ):
+                rollups[key][0] += 1
+                rollups[key][1] += duration
+                if recruiting:
+                    rollups[key][2] += duration
+            for collaborator_id in attendees[pk] - {calendar_id}:
+                collaborations[(collaborator_id, month)] += 1
+
+        for model in (WeeklyRollup, MonthlyRollup):
+            model.objects.filter(calendar_id=calendar_id).delete()
+            model.objects.bulk_create(
+                [
+                    model(
+                        calendar_id=calendar_id,
+                        period_start=period_start,
+                        meeting_count=count,
+                        total_duration=total,
+                        recruiting_duration=recruiting,
+                    )
+                    for (m, period_start), (count, total, recruiting) in rollups.items()
+                    if m is model
+                ]
+            )
+        Collaboration.objects.filter(calendar_id=calendar_id).delete()
+        Collaboration.objects.bulk_create(
+            [
+                Collaboration(
+                    calendar_id=calendar_id,
+                    collaborator_id=collaborator_id,
+                    period_start=period_start,
+                    meeting_count=count,
+                )
+                for (collaborator_id, period_start), count in collaborations.items()
+            ]
+        )
+        # Reports cached from the old rollups are invalidated
+        Calendar.objects.filter(pk=calendar_id).update(
+            data_version=F("data_version") + 1
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0025_collaboration"),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("audit", "0026_rebuild_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="syncing_since",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
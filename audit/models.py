@@ -1,22 +1,49 @@
+from django.conf import settings
 from django.db import models
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from django.contrib.auth.models import AbstractUser
 import json
 
 
 class Calendar(models.Model):
-    email = models.CharField(max_length=255)
+    email = models.CharField(max_length=255, unique=True)
     timezone = models.CharField(max_length=255, blank=True, null=True)
     sync_token = models.CharField(max_length=255, blank=True, null=True)
+    page_token = models.CharField(max_length=255, blank=True, null=True)
+    last_synced = models.DateTimeField(blank=True, null=True)
+    # Bumped whenever a sync writes events this calendar's reports depend on
+    data_version = models.PositiveIntegerField(default=0)
+    # Window fetched by a bounded initial sync, history outside of it hasn't been backfilled yet
+    synced_from = models.DateTimeField(blank=True, null=True)
+    synced_until = models.DateTimeField(blank=True, null=True)
+    # Events persisted by the unfinished sync so far, checkpointed together with page_token
+    synced_events = models.PositiveIntegerField(default=0)
+    # Set while re-listing the calendar after its sync token expired, events the listing
+    # doesn't return are removed once it completes
+    resyncing = models.BooleanField(default=False)
+    # Claimed by the process syncing the calendar (refreshed with every checkpoint), so syncs started from
+    # other processes skip it instead of racing on its tokens. Claims older than AUDIT_SYNC_CLAIM_TIMEOUT
+    # are left over from a crashed sync and can be taken over
+    syncing_since = models.DateTimeField(blank=True, null=True)
 
     def __str__(self) -> str:
         return self.email
 
+    def is_windowed(self) -> bool:
+        """True if only part of the calendar's history has been fetched"""
+        return bool(self.synced_from or self.synced_until)
+
+    def is_stale(self) -> bool:
+        """True if the calendar hasn't been synced within the staleness window"""
+        if not self.last_synced:
+            return True
+        return datetime.now(timezone.utc) - self.last_synced > settings.AUDIT_SYNC_STALENESS
+
 
 class WatchChannel(models.Model):
     id = models.UUIDField(primary_key=True)
     resource_id = models.CharField(max_length=255)
-    expiration = models.DateTimeField()
+    expiration = models.DateTimeField(db_index=True)
     calendar = models.OneToOneField(
         Calendar,
         on_delete=models.CASCADE,
@@ -24,6 +51,8 @@ class WatchChannel(models.Model):
         null=True,
         related_name="channel",
     )
+    # Highest X-Goog-Message-Number handled, older and repeated deliveries are dropped
+    message_number = models.BigIntegerField(default=0)
 
     def is_valid(self) -> bool:
         if self.expiration >= datetime.now(timezone.utc):
@@ -36,6 +65,8 @@ class User(AbstractUser):
     primary_calendar = models.OneToOneField(
         Calendar, on_delete=models.PROTECT, blank=True, null=True
     )
+    # Every calendar the user can read and has synced (including the primary calendar)
+    calendars = models.ManyToManyField(Calendar, related_name="readers", blank=True)
 
     @property
     def auth_info(self):
@@ -51,6 +82,11 @@ class Attendee(models.Model):
     )
     response_status = models.CharField(max_length=255)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["event", "calendar"], name="unique_attendee")
+        ]
+
     def __str__(self) -> str:
         return f"{self.calendar} - {self.event}"
 
@@ -71,10 +107,89 @@ class Event(models.Model):
 
     start = models.DateTimeField()
     duration = models.DurationField()
+    # Last modification time of the event on Google's side
+    updated = models.DateTimeField(blank=True, null=True)
+
+    # RRULE/EXRULE/RDATE/EXDATE lines of a recurring master, only stored when
+    # AUDIT_EXPAND_RECURRING is off, the occurrences are then expanded by the reports
+    recurrence = models.JSONField(blank=True, null=True)
+    # Exceptions (modified or cancelled occurrences) point at their master and the occurrence they replace
+    recurring_event_id = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    original_start = models.DateTimeField(blank=True, null=True)
 
     attendees = models.ManyToManyField(
         Calendar, through=Attendee, related_name="attended_events"
     )
 
+    class Meta:
+        constraints = [
+            # The same meeting is shared between the calendars of its attendees,
+            # this also indexes the google_id lookups of the sync
+            models.UniqueConstraint(fields=["google_id", "organizer"], name="unique_event")
+        ]
+        indexes = [
+            # Reports only ever look at timed events by start
+            models.Index(
+                fields=["start"], condition=models.Q(all_day=False), name="event_timed_start_idx"
+            ),
+            models.Index(fields=["start", "all_day"], name="event_start_all_day_idx"),
+        ]
+
     def __str__(self) -> str:
         return f"{self.summary}: {self.start}"
+
+
+class Rollup(models.Model):
+    """Pre-aggregated meeting totals for a calendar over one period.
+    Kept up to date by the EventBuilder as events are saved and deleted"""
+
+    calendar = models.ForeignKey(Calendar, on_delete=models.CASCADE)
+    period_start = models.DateField()
+    meeting_count = models.IntegerField(default=0)
+    total_duration = models.DurationField(default=timedelta)
+    recruiting_duration = models.DurationField(default=timedelta)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self) -> str:
+        return f"{self.calendar} - {self.period_start}"
+
+
+class WeeklyRollup(Rollup):
+    """Totals for the ISO week starting (Monday) on period_start"""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["calendar", "period_start"], name="unique_weekly_rollup")
+        ]
+
+
+class MonthlyRollup(Rollup):
+    """Totals for the month starting on period_start"""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["calendar", "period_start"], name="unique_monthly_rollup")
+        ]
+
+
+class Collaboration(models.Model):
+    """Number of meetings on a calendar that a collaborator attended in the month starting on period_start.
+    Kept up to date by the EventBuilder alongside the rollups"""
+
+    calendar = models.ForeignKey(Calendar, on_delete=models.CASCADE, related_name="collaborations")
+    collaborator = models.ForeignKey(Calendar, on_delete=models.CASCADE, related_name="+")
+    period_start = models.DateField()
+    meeting_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also indexes the (calendar, period_start) range scans of the reports
+            models.UniqueConstraint(
+                fields=["calendar", "period_start", "collaborator"], name="unique_collaboration"
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.calendar} - {self.collaborator} ({self.period_start})"
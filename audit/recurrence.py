@@ -0,0 +1,23 @@
+import re
+from datetime import datetime
+from dateutil.rrule import rrulestr
+from .models import Event
+from .utils import get_tz
+
+# dateutil requires UNTIL in UTC when DTSTART is aware, Google also writes it as a date or floating time
+_UNTIL = re.compile(r"UNTIL=(\d{8})(T\d{6})?Z?")
+
+
+def _utc_until(line: str) -> str:
+    return _UNTIL.sub(lambda m: f"UNTIL={m[1]}{m[2] or 'T235959'}Z", line)
+
+
+def occurrences(master: Event, time_min: datetime, time_max: datetime, tz: str, skip=()) -> list[datetime]:
+    """Returns the starts of the recurring master's occurrences between time_min and time_max (inclusive).
+    The rules are expanded in the calendar's timezone so occurrences keep their wall time across DST,
+    starts in skip (the original starts of exceptions) are left out"""
+    dtstart = master.start.astimezone(get_tz(tz or "UTC"))
+    rules = rrulestr(
+        "\n".join(_utc_until(line) for line in master.recurrence), dtstart=dtstart, forceset=True
+    )
+    return [start for start in rules.between(time_min, time_max, inc=True) if start not in skip]
@@ -1,122 +1,449 @@
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from functools import cached_property
 from dateutil.relativedelta import relativedelta
-from .models import User
-from django.db.models.functions import ExtractYear, ExtractMonth, ExtractWeek
-from django.db.models import Sum, Count, Avg, F, Q
-from .utils import DateUtil
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, Sum
+from .instrumentation import span
+from .models import Attendee, Collaboration, Event, MonthlyRollup, User, WeeklyRollup
+from .recurrence import occurrences
+from .rollups import periods
+from .utils import RECRUITING_KEYWORDS, DateUtil, get_tz, is_recruiting
+
+
+def _expand(masters, time_min: datetime, time_max: datetime, tz: str) -> list[tuple[Event, list[datetime]]]:
+    """The recurring masters with the starts of their occurrences between time_min and time_max"""
+    masters = list(masters)
+    if not masters:
+        return []
+
+    # Modified and cancelled exceptions replace the occurrence they were created from
+    skip = defaultdict(set)
+    exceptions = Event.objects.filter(
+        recurring_event_id__in=[master.google_id for master in masters], original_start__isnull=False
+    )
+    for master_id, original_start in exceptions.values_list("recurring_event_id", "original_start"):
+        skip[master_id].add(original_start)
+
+    return [(master, occurrences(master, time_min, time_max, tz, skip[master.google_id])) for master in masters]
+
+
+def _add_occurrences(
+    model, rollups, calendar_id: int, tz: str, expanded, time_min: datetime, period_max: datetime
+) -> list:
+    """Adds the occurrences of the expanded recurring masters to the calendar's rollups of the full periods
+    they fall in (in the calendar's timezone tz), returning the rollups with meetings by period"""
+    by_period = {r.period_start: r for r in rollups}
+    index = 0 if model is WeeklyRollup else 1
+    for master, starts in expanded:
+        recruiting = master.duration if is_recruiting(master.summary) else timedelta()
+        for start in starts:
+            period_start = periods(start, tz)[index]
+            if not time_min.date() <= period_start < period_max.date():
+                continue
+            if period_start not in by_period:
+                by_period[period_start] = model(calendar_id=calendar_id, period_start=period_start)
+            rollup = by_period[period_start]
+            rollup.meeting_count += 1
+            rollup.total_duration += master.duration
+            rollup.recruiting_duration += recruiting
+
+    return sorted((r for r in by_period.values() if r.meeting_count > 0), key=lambda r: r.period_start)
+
 
 class ReportBuilder:
-    def __init__(self, user: User, num_months=3) -> None:
+    """Builds the dashboard metrics for a user's primary calendar.
+    Monthly and weekly metrics are read from the pre-aggregated rollups so the cost of a report
+    doesn't grow with the calendar's history, only the partial current month touches the events.
+    Recurring masters (stored when AUDIT_EXPAND_RECURRING is off) are expanded over the report window
+    and merged into the rollups"""
+
+    def __init__(self, user: User, num_months=3, now: datetime = None) -> None:
+        """now (the current time by default) fixes the report window, e.g. for reproducible benchmarks"""
         self.user = user
-        self.tz = user.primary_calendar.timezone
+        self.calendar = user.primary_calendar
+        self.tz = self.calendar.timezone
         self.num_months = num_months
-    
-    def _filter_by_range(self, max_date_type: str="month"):
-        d = DateUtil(tz=self.tz)
-        time_max = None
-        
-        if max_date_type == "month":
-            time_max = d.this_month
-        elif max_date_type == "week":
-            time_max = d.this_week
-        elif max_date_type == "day":
-            time_max = d.today
-        
-        time_min = d.this_month - relativedelta(months=self.num_months)
-
-        events = self.user.primary_calendar.events
-        return events.filter(start__range=(time_min, time_max), all_day=False)
 
-    def get_time_per_month(self):
-        """Returns the total time spent in meetings per Month for the last x months up to the the start of the current month"""
+        d = DateUtil(dt=now.astimezone(get_tz(self.tz)) if now else None, tz=self.tz)
+        self.time_min = d.this_month - relativedelta(months=self.num_months)
+        self.month_max = d.this_month
+        self.week_max = d.this_week
+        self.day_max = d.today
+
+    def _filter_by_range(self, time_min=None):
+        """Timed events from the start of the report window (or time_min) up to today"""
+        events = self.calendar.events.filter(
+            start__range=(time_min or self.time_min, self.day_max), all_day=False, recurrence__isnull=True
+        )
+        return events.exclude(status="cancelled")
+
+    @cached_property
+    def _occurrences(self) -> list[tuple[Event, list[datetime]]]:
+        """The calendar's recurring masters with the starts of their occurrences in the report window"""
+        if settings.AUDIT_EXPAND_RECURRING:
+            return []
+
+        masters = self.calendar.events.filter(recurrence__isnull=False, all_day=False, start__lte=self.day_max)
+        return _expand(masters.exclude(status="cancelled"), self.time_min, self.day_max, self.tz)
 
-        events = self._filter_by_range("month")
+    def _add_occurrences(self, model, rollups, period_max: datetime) -> list:
+        return _add_occurrences(
+            model, rollups, self.calendar.pk, self.tz, self._occurrences, self.time_min, period_max
+        )
+
+    @cached_property
+    def _months(self) -> list[MonthlyRollup]:
+        """The full months of the report window"""
+        rollups = MonthlyRollup.objects.filter(
+            calendar=self.calendar,
+            period_start__gte=self.time_min.date(),
+            period_start__lt=self.month_max.date(),
+            meeting_count__gt=0,
+        )
+        return self._add_occurrences(MonthlyRollup, rollups, self.month_max)
+
+    @cached_property
+    def _weeks(self) -> list[WeeklyRollup]:
+        """The full weeks of the report window"""
+        rollups = WeeklyRollup.objects.filter(
+            calendar=self.calendar,
+            period_start__gte=self.time_min.date(),
+            period_start__lt=self.week_max.date(),
+            meeting_count__gt=0,
+        )
+        return self._add_occurrences(WeeklyRollup, rollups, self.week_max)
+
+    @cached_property
+    def _occurrence_attendance(self) -> list[tuple[str, datetime]]:
+        """(email, start) of every collaborator of every occurrence of the recurring masters"""
+        starts = {master.pk: starts for master, starts in self._occurrences if starts}
+        if not starts:
+            return []
 
-        results = (
-            events.annotate(month=ExtractMonth("start"))
-            .values("month")
-            .annotate(time=Sum("duration"))
-            .order_by("month")
+        attendance = Attendee.objects.filter(event__in=starts).exclude(calendar=self.calendar)
+        return [
+            (email, start)
+            for event_id, email in attendance.values_list("event_id", "calendar__email")
+            for start in starts[event_id]
+        ]
+
+    def _cache_key(self, num_people: int) -> str:
+        # The data version changes whenever a sync writes to the calendar and the date rolls the
+        # report window over, so old entries are never read again and simply expire
+        return ":".join(
+            str(part)
+            for part in (
+                "report",
+                self.calendar.pk,
+                self.num_months,
+                num_people,
+                self.day_max.date(),
+                self.calendar.data_version,
+            )
         )
-        return results
 
+    @span("report.full")
+    def get_report(self, num_people: int = 3) -> dict:
+        """Returns every dashboard metric, served from the cache unless the calendar's data has changed"""
+        key = self._cache_key(num_people)
+        report = cache.get(key)
+        if report is not None:
+            return report
+
+        min_meetings, max_meetings = self.get_most_and_least_meetings()
+        light_week, busy_week = self.get_busiest_weeks()
+        report = {
+            "time_per_month": self.get_time_per_month(),
+            "min_meetings": min_meetings,
+            "max_meetings": max_meetings,
+            "light_week": light_week,
+            "busy_week": busy_week,
+            "avg_meetings_week": self.get_avg_meetings_week(),
+            "avg_time_meetings_week": self.get_avg_time_meetings_week(),
+            "top_collaborators": self.get_top_collaborators(num_people),
+            "time_recruiting": self.get_time_recruiting(),
+        }
+        cache.set(key, report, settings.AUDIT_REPORT_CACHE_TIMEOUT)
+        return report
 
+    @span("report.time_per_month")
+    def get_time_per_month(self):
+        """Returns the total time spent in meetings per Month for the last x months up to the the start of the current month"""
+
+        return [{"month": r.period_start.month, "time": r.total_duration} for r in self._months]
+
+
+    @span("report.most_and_least_meetings")
     def get_most_and_least_meetings(self):
         """Returns Most and Least # of meetings per Month for the last x months up to the the start of the current month
         in the form of (min#, max#)"""
 
-        events = self._filter_by_range("month")
-        results = (
-            events.annotate(month=ExtractMonth("start"))
-            .values("month")
-            .annotate(count=Count("pk"))
-            .order_by("count")
-        )
-        return results.first(), results.last()
+        results = [{"month": r.period_start.month, "count": r.meeting_count} for r in self._months]
+        return self._min_max(results, "count")
 
 
+    @span("report.busiest_weeks")
     def get_busiest_weeks(self):
         """Returns Most and Least time spent in meetings per week for the last x months up to the last full-week
         in the form of (min#, max#)"""
 
-        events = self._filter_by_range("week")
-        results = (
-            events.annotate(week=ExtractWeek("start"))
-            .annotate(year=ExtractYear("start"))
-            .values("week", "year")
-            .annotate(time=Sum("duration"))
-            .order_by("time")
-        )
-        return results.first(), results.last()
+        results = []
+        for r in self._weeks:
+            year, week, _ = r.period_start.isocalendar()
+            results.append({"week": week, "year": year, "time": r.total_duration})
+        return self._min_max(results, "time")
 
 
+    @span("report.avg_meetings_week")
     def get_avg_meetings_week(self):
         """Returns Avg # of meetings per week for the last x months up to the last full-week"""
 
-        events = self._filter_by_range("week")
-        results = (
-            events.annotate(week=ExtractWeek("start"))
-            .values("week")
-            .annotate(count=Count("pk"))
-            .aggregate(avg=Avg("count"))
-        )
-        return results
+        counts = [r.meeting_count for r in self._weeks]
+        return {"avg": sum(counts) / len(counts) if counts else None}
 
 
+    @span("report.avg_time_meetings_week")
     def get_avg_time_meetings_week(self):
         """Returns Avg time of meetings per week for the last x months up to the last full-week"""
 
-        events = self._filter_by_range("week")
-        results = (
-            events.annotate(week=ExtractWeek("start"))
-            .values("week")
-            .annotate(time=Sum("duration"))
-            .aggregate(avg=Avg("time"))
-        )
-        return results
+        times = [r.total_duration for r in self._weeks]
+        return {"avg": sum(times, timedelta()) / len(times) if times else None}
 
 
+    @span("report.top_collaborators")
     def get_top_collaborators(self, num_people: int):
         """Return the top x # of people you have met with in the last y months up to today"""
-        events = self._filter_by_range("day")
-        results = (
-            events.annotate(email=F("attendees__email"))
-            .exclude(email=self.user.primary_calendar.email)
-            .values("email")
-            .annotate(count=Count("email"))
-            .order_by("-count")
+        # Full months come from the collaborations, the current month is counted from its attendance
+        collaborations = (
+            Collaboration.objects.filter(
+                calendar=self.calendar,
+                period_start__gte=self.time_min.date(),
+                period_start__lt=self.month_max.date(),
+            )
+            .values_list("collaborator__email")
+            .annotate(count=Sum("meeting_count"))
         )
-        return results[:num_people]
+        counts = Counter(dict(collaborations))
+        counts.update(
+            Attendee.objects.filter(event__in=self._filter_by_range(self.month_max))
+            .exclude(calendar=self.calendar)
+            .values_list("calendar__email", flat=True)
+        )
+        counts.update(email for email, _ in self._occurrence_attendance)
+        return [{"email": email, "count": count} for email, count in counts.most_common(num_people) if count > 0]
 
+    @span("report.collaborator_trend")
+    def get_collaborator_trend(self, email: str):
+        """Returns the # of meetings with a collaborator in each month of the last x months up to the start of the current month"""
+        months = Counter(
+            dict(
+                Collaboration.objects.filter(
+                    calendar=self.calendar,
+                    collaborator__email=email,
+                    period_start__gte=self.time_min.date(),
+                    period_start__lt=self.month_max.date(),
+                ).values_list("period_start", "meeting_count")
+            )
+        )
+        for collaborator, start in self._occurrence_attendance:
+            month = periods(start, self.tz)[1]
+            if collaborator == email and month < self.month_max.date():
+                months[month] += 1
+        return [{"month": month.month, "count": count} for month, count in sorted(months.items()) if count > 0]
 
+    @span("report.time_recruiting")
     def get_time_recruiting(self):
         """Return the time spent recruiting or conducting interviews
         Filters on if a Meeting Title [summary] contains certain keywords"""
 
-        keywords = ["recruiting", "interview"]
+        # Full months come from the rollups, the current month is summed from its events
+        time = sum((r.recruiting_duration for r in self._months), timedelta())
+
         kw_filter = Q()
-        for kw in keywords:
+        for kw in RECRUITING_KEYWORDS:
             kw_filter |= Q(summary__icontains=kw)
+        current = self._filter_by_range(self.month_max).filter(kw_filter).aggregate(time=Sum("duration"))
+        if current["time"]:
+            time += current["time"]
+        for master, starts in self._occurrences:
+            if is_recruiting(master.summary):
+                time += master.duration * sum(start >= self.month_max for start in starts)
+
+        return {"time": time or None}
+
+    @staticmethod
+    def _min_max(results: list[dict], key: str):
+        if not results:
+            return None, None
+        results.sort(key=lambda r: r[key])
+        return results[0], results[-1]
+
+
+class TeamReportBuilder:
+    """Builds the dashboard metrics of a set of calendars (e.g. a team) at once.
+    Each metric is read for every calendar with a single query and grouped by calendar in memory,
+    so a team report runs the same handful of queries as a single ReportBuilder however large the team.
+    Every calendar's window is cut in its own timezone, the one its rollups are bucketed in"""
+
+    def __init__(self, calendars, num_months=3) -> None:
+        self.calendars = {calendar.pk: calendar for calendar in calendars}
+        self.num_months = num_months
+        # Calendars without a timezone are bucketed in TIME_ZONE by the rollups
+        self.timezones = {pk: calendar.timezone or settings.TIME_ZONE for pk, calendar in self.calendars.items()}
+
+        # timezone -> (time_min, month_max, week_max, day_max)
+        self.windows = {}
+        for tz in set(self.timezones.values()):
+            d = DateUtil(tz=tz)
+            self.windows[tz] = (
+                d.this_month - relativedelta(months=self.num_months),
+                d.this_month,
+                d.this_week,
+                d.today,
+            )
+
+    def _window(self, calendar_id: int) -> tuple[datetime, datetime, datetime, datetime]:
+        return self.windows[self.timezones[calendar_id]]
+
+    @cached_property
+    def _occurrences(self) -> dict[int, list[tuple[Event, list[datetime]]]]:
+        """The recurring masters with the starts of their occurrences in the report window, by calendar"""
+        if settings.AUDIT_EXPAND_RECURRING or not self.calendars:
+            return {}
+
+        links = Event.calendars.through.objects.filter(
+            calendar_id__in=self.calendars,
+            event__recurrence__isnull=False,
+            event__all_day=False,
+            event__start__lte=max(day_max for *_, day_max in self.windows.values()),
+        ).exclude(event__status="cancelled")
+        calendar_ids = defaultdict(list)
+        for event_id, calendar_id in links.values_list("event_id", "calendar_id"):
+            calendar_ids[event_id].append(calendar_id)
+        if not calendar_ids:
+            return {}
 
-        events = self._filter_by_range("day")
-        results = events.filter(kw_filter).aggregate(time=Sum("duration"))
-        return results
+        # Occurrences keep their wall time in the timezone they are expanded in
+        masters = list(Event.objects.filter(pk__in=calendar_ids))
+        by_calendar = defaultdict(list)
+        for tz, (time_min, _, _, day_max) in self.windows.items():
+            on_tz = [m for m in masters if any(self.timezones[c] == tz for c in calendar_ids[m.pk])]
+            for master, starts in _expand(on_tz, time_min, day_max, tz):
+                for calendar_id in calendar_ids[master.pk]:
+                    if self.timezones[calendar_id] == tz:
+                        by_calendar[calendar_id].append((master, starts))
+        return by_calendar
+
+    def _rollups(self, model, index: int) -> dict[int, list]:
+        """The rollups of the full periods of each calendar's report window, by calendar.
+        index picks the end of the full periods out of the window (month_max or week_max)"""
+        if not self.calendars:
+            return {}
+
+        by_calendar = defaultdict(list)
+        rollups = model.objects.filter(
+            calendar__in=self.calendars,
+            period_start__gte=min(window[0] for window in self.windows.values()).date(),
+            period_start__lt=max(window[index] for window in self.windows.values()).date(),
+            meeting_count__gt=0,
+        )
+        for rollup in rollups:
+            window = self._window(rollup.calendar_id)
+            if window[0].date() <= rollup.period_start < window[index].date():
+                by_calendar[rollup.calendar_id].append(rollup)
+
+        return {
+            calendar_id: _add_occurrences(
+                model,
+                by_calendar[calendar_id],
+                calendar_id,
+                self.timezones[calendar_id],
+                self._occurrences.get(calendar_id, []),
+                self._window(calendar_id)[0],
+                self._window(calendar_id)[index],
+            )
+            for calendar_id in self.calendars
+        }
+
+    def _current_recruiting(self) -> dict[int, timedelta]:
+        """Time spent recruiting in the current month, by calendar"""
+        time = defaultdict(timedelta)
+        if not self.calendars:
+            return time
+
+        kw_filter = Q()
+        for kw in RECRUITING_KEYWORDS:
+            kw_filter |= Q(event__summary__icontains=kw)
+        # The current month of each timezone
+        current = Q()
+        for tz, (_, month_max, _, day_max) in self.windows.items():
+            calendar_ids = [pk for pk, calendar_tz in self.timezones.items() if calendar_tz == tz]
+            current |= Q(calendar_id__in=calendar_ids, event__start__range=(month_max, day_max))
+        links = (
+            Event.calendars.through.objects.filter(
+                kw_filter, current, event__all_day=False, event__recurrence__isnull=True
+            )
+            .exclude(event__status="cancelled")
+            .values_list("calendar_id")
+            .annotate(time=Sum("event__duration"))
+        )
+        time.update(links)
+
+        for calendar_id, expanded in self._occurrences.items():
+            month_max = self._window(calendar_id)[1]
+            for master, starts in expanded:
+                if is_recruiting(master.summary):
+                    time[calendar_id] += master.duration * sum(start >= month_max for start in starts)
+        return time
+
+    def get_report(self) -> dict:
+        """Returns the dashboard metrics of each calendar by email, and the team's totals per month"""
+        with span("report.team", calendars=len(self.calendars)):
+            months = self._rollups(MonthlyRollup, 1)
+            weeks = self._rollups(WeeklyRollup, 2)
+            recruiting = self._current_recruiting()
+
+            team = defaultdict(lambda: [0, timedelta()])
+            reports = {}
+            for calendar_id, calendar in self.calendars.items():
+                for r in months[calendar_id]:
+                    team[r.period_start][0] += r.meeting_count
+                    team[r.period_start][1] += r.total_duration
+                reports[calendar.email] = self._calendar_report(
+                    months[calendar_id], weeks[calendar_id], recruiting[calendar_id]
+                )
+
+            return {
+                "calendars": reports,
+                "team": [
+                    {"month": period_start.month, "count": count, "time": time}
+                    for period_start, (count, time) in sorted(team.items())
+                ],
+            }
+
+    @staticmethod
+    def _calendar_report(months: list[MonthlyRollup], weeks: list[WeeklyRollup], recruiting: timedelta) -> dict:
+        """The metrics of ReportBuilder.get_report (bar the collaborators) from a calendar's rollups"""
+        min_meetings, max_meetings = ReportBuilder._min_max(
+            [{"month": r.period_start.month, "count": r.meeting_count} for r in months], "count"
+        )
+        results = []
+        for r in weeks:
+            year, week, _ = r.period_start.isocalendar()
+            results.append({"week": week, "year": year, "time": r.total_duration})
+        light_week, busy_week = ReportBuilder._min_max(results, "time")
+        counts = [r.meeting_count for r in weeks]
+        times = [r.total_duration for r in weeks]
+        recruiting += sum((r.recruiting_duration for r in months), timedelta())
+        return {
+            "time_per_month": [{"month": r.period_start.month, "time": r.total_duration} for r in months],
+            "min_meetings": min_meetings,
+            "max_meetings": max_meetings,
+            "light_week": light_week,
+            "busy_week": busy_week,
+            "avg_meetings_week": {"avg": sum(counts) / len(counts) if counts else None},
+            "avg_time_meetings_week": {"avg": sum(times, timedelta()) / len(times) if times else None},
+            "time_recruiting": {"time": recruiting or None},
+        }
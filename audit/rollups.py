@@ -0,0 +1,168 @@
+from collections import defaultdict
+from datetime import date, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from .models import Attendee, Calendar, Collaboration, Event, MonthlyRollup, WeeklyRollup
+from .utils import get_tz, is_recruiting
+
+
+def periods(start, tz: str = None) -> tuple[date, date]:
+    """Returns the (week, month) start dates an event starting at `start` is bucketed into.
+    Buckets use the calendar's timezone tz, the same one its reports cut their windows in"""
+    local = start.astimezone(get_tz(tz or settings.TIME_ZONE)).date()
+    return local - timedelta(days=local.weekday()), local.replace(day=1)
+
+
+class RollupDelta:
+    """Accumulates the changes a batch of event writes makes to the weekly and monthly rollups
+    and the collaborations so they can be applied with a few bulk queries.
+    Events are bucketed into periods in the timezone of each calendar, timezones is the
+    calendar id -> timezone of the calendars known up front, the others are looked up on apply"""
+
+    def __init__(self, timezones: dict[int, str] = None) -> None:
+        self.timezones = dict(timezones or {})
+        # (calendar ids, start, duration, recruiting, sign, attendee ids) of the added events
+        self._events = []
+        self._deltas = {
+            WeeklyRollup: defaultdict(lambda: [0, timedelta(), timedelta()]),
+            MonthlyRollup: defaultdict(lambda: [0, timedelta(), timedelta()]),
+        }
+        # (calendar id, collaborator id, month) -> meetings
+        self._collaborations = defaultdict(int)
+
+    def add(self, event: Event, calendar_ids, sign=1, attendees=()) -> None:
+        """Adds (or with sign=-1 removes) the event's contribution to each of the calendars,
+        attendees are the calendar ids of the event's attendees.
+        Recurring masters are expanded by the reports and cancelled exceptions aren't meetings"""
+        if event.all_day or event.recurrence or event.status == "cancelled":
+            return
+
+        recruiting = event.duration if is_recruiting(event.summary) else timedelta()
+        self._events.append((list(calendar_ids), event.start, event.duration, recruiting, sign, list(attendees)))
+
+    def _bucket(self) -> None:
+        """Turns the added events into deltas of the periods they fall in on each calendar"""
+        missing = {calendar_id for calendar_ids, *_ in self._events for calendar_id in calendar_ids}
+        missing -= self.timezones.keys()
+        if missing:
+            self.timezones.update(Calendar.objects.filter(pk__in=missing).values_list("pk", "timezone"))
+
+        for calendar_ids, start, duration, recruiting, sign, attendees in self._events:
+            for calendar_id in calendar_ids:
+                week, month = periods(start, self.timezones.get(calendar_id))
+                for model, period_start in ((WeeklyRollup, week), (MonthlyRollup, month)):
+                    delta = self._deltas[model][(calendar_id, period_start)]
+                    delta[0] += sign
+                    delta[1] += sign * duration
+                    delta[2] += sign * recruiting
+
+                for collaborator_id in attendees:
+                    if collaborator_id != calendar_id:
+                        self._collaborations[(calendar_id, collaborator_id, month)] += sign
+        self._events.clear()
+
+    def remove_events(self, events, calendar_ids=None) -> None:
+        """Removes the contributions of the events from every calendar they are linked to
+        (or only from the given calendars)"""
+        through = Event.calendars.through
+        rows = through.objects.filter(event__in=events)
+        if calendar_ids is not None:
+            rows = rows.filter(calendar_id__in=calendar_ids)
+
+        links = defaultdict(list)
+        for event_id, calendar_id in rows.values_list("event_id", "calendar_id"):
+            links[event_id].append(calendar_id)
+
+        attendees = defaultdict(set)
+        for event_id, calendar_id in Attendee.objects.filter(event__in=events).values_list(
+            "event_id", "calendar_id"
+        ):
+            attendees[event_id].add(calendar_id)
+
+        fields = ("pk", "all_day", "start", "duration", "summary", "status", "recurrence")
+        for event in events.only(*fields).iterator():
+            self.add(event, links[event.pk], sign=-1, attendees=attendees[event.pk])
+
+    @transaction.atomic
+    def apply(self) -> None:
+        self._bucket()
+        for model, deltas in self._deltas.items():
+            # Changes that cancel out (e.g. a re-saved event that didn't move) need no writes
+            deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+            if not deltas:
+                continue
+
+            calendar_ids = {calendar_id for calendar_id, _ in deltas}
+            period_starts = {period_start for _, period_start in deltas}
+
+            # Make sure every row exists, then lock them so concurrent syncs can't lose updates
+            model.objects.bulk_create(
+                [model(calendar_id=c, period_start=p) for c, p in deltas], ignore_conflicts=True
+            )
+            rows = model.objects.select_for_update().filter(
+                calendar_id__in=calendar_ids, period_start__in=period_starts
+            )
+
+            to_update = []
+            for row in rows:
+                delta = deltas.get((row.calendar_id, row.period_start))
+                if not delta:
+                    continue
+                row.meeting_count += delta[0]
+                row.total_duration += delta[1]
+                row.recruiting_duration += delta[2]
+                to_update.append(row)
+
+            model.objects.bulk_update(
+                to_update, ["meeting_count", "total_duration", "recruiting_duration"]
+            )
+
+        for deltas in self._deltas.values():
+            deltas.clear()
+        self._apply_collaborations()
+
+    def _apply_collaborations(self) -> None:
+        deltas = {key: delta for key, delta in self._collaborations.items() if delta}
+        self._collaborations.clear()
+        if not deltas:
+            return
+
+        Collaboration.objects.bulk_create(
+            [Collaboration(calendar_id=c, collaborator_id=a, period_start=p) for c, a, p in deltas],
+            ignore_conflicts=True,
+        )
+        rows = Collaboration.objects.select_for_update().filter(
+            calendar_id__in={c for c, _, _ in deltas},
+            collaborator_id__in={a for _, a, _ in deltas},
+            period_start__in={p for _, _, p in deltas},
+        )
+
+        to_update = []
+        for row in rows:
+            delta = deltas.get((row.calendar_id, row.collaborator_id, row.period_start))
+            if delta:
+                row.meeting_count += delta
+                to_update.append(row)
+        Collaboration.objects.bulk_update(to_update, ["meeting_count"])
+
+
+@transaction.atomic
+def rebuild(calendar: Calendar) -> None:
+    """Recomputes every rollup and collaboration of the calendar from its events, invalidating its cached reports"""
+    WeeklyRollup.objects.filter(calendar=calendar).delete()
+    MonthlyRollup.objects.filter(calendar=calendar).delete()
+    Collaboration.objects.filter(calendar=calendar).delete()
+
+    delta = RollupDelta({calendar.pk: calendar.timezone})
+    events = calendar.events.filter(all_day=False, recurrence__isnull=True).exclude(status="cancelled")
+    attendees = defaultdict(set)
+    for event_id, calendar_id in Attendee.objects.filter(event__in=events).values_list("event_id", "calendar_id"):
+        attendees[event_id].add(calendar_id)
+
+    events = events.only("pk", "all_day", "start", "duration", "summary", "status", "recurrence")
+    for event in events.iterator():
+        delta.add(event, [calendar.pk], attendees=attendees[event.pk])
+    delta.apply()
+    # Reports cached from the old rollups are invalidated
+    Calendar.objects.filter(pk=calendar.pk).update(data_version=F("data_version") + 1)
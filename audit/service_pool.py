@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from typing import Callable
+import google_auth_httplib2
+import httplib2
+from django.conf import settings
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from .instrumentation import span
+from .models import User
+
+
+class PooledService:
+    def __init__(self, creds: Credentials, token: str) -> None:
+        self.creds = creds
+        # The auth_token the credentials were built from, a re-login replaces it
+        self.token = token
+        self.lock = threading.Lock()
+        self.service = build(
+            "calendar",
+            "v3",
+            credentials=creds,
+            requestBuilder=self._build_request,
+            static_discovery=True,
+            cache_discovery=False,
+        )
+
+    def _build_request(self, http, *args, **kwargs) -> HttpRequest:
+        # httplib2 isn't thread safe, giving every request its own Http lets the
+        # pooled service be shared between the request and sync worker threads
+        authed_http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+        return HttpRequest(authed_http, *args, **kwargs)
+
+
+class ServicePool:
+    """Process-level LRU of built Calendar API services and their credentials, keyed by user.
+    Building a service parses the discovery document, so it is only done once per user
+    and expired credentials are refreshed in place instead"""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user: User, get_creds: Callable[[], Credentials]) -> tuple[Credentials, object]:
+        """Returns the (credentials, service) of the user, building them with get_creds if they aren't pooled"""
+        with self._lock:
+            entry = self._entries.get(user.pk)
+            if entry and entry.token == user.auth_token:
+                self._entries.move_to_end(user.pk)
+            else:
+                entry = None
+
+        if entry:
+            if not entry.creds.valid:
+                with span("calendar.creds_refresh", user=user.pk):
+                    self._refresh(user, entry)
+            return entry.creds, entry.service
+
+        with span("calendar.creds", user=user.pk):
+            creds = get_creds()
+        with span("calendar.build", user=user.pk):
+            entry = PooledService(creds, user.auth_token)
+        with self._lock:
+            self._entries[user.pk] = entry
+            self._entries.move_to_end(user.pk)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return entry.creds, entry.service
+
+    def _refresh(self, user: User, entry: PooledService) -> None:
+        with entry.lock:
+            # Another thread may have refreshed the credentials while we waited
+            if entry.creds.valid:
+                return
+            entry.creds.refresh(Request())
+            entry.token = entry.creds.to_json()
+
+        user.auth_token = entry.token
+        user.save(update_fields=["auth_token"])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+service_pool = ServicePool(max_size=getattr(settings, "AUDIT_SERVICE_POOL_SIZE", 128))
@@ -0,0 +1,200 @@
+"""Columnar snapshots of the events and attendance for offline analytics.
+
+A snapshot is a directory of raw column files, one per column of each table, plus a dictionary of the
+calendars' emails and a manifest. Columns are plain arrays of fixed-width integers in the byte order
+of the exporting machine, so they can be memory-mapped (by Snapshot, or np.memmap with the dtype
+recorded in the manifest) and aggregated without loading the dataset.
+
+    events      id, start (epoch seconds), duration (seconds), organizer (email index), flags
+    links       event (event id), calendar (email index): the calendars each event is on
+    attendees   event (event id), calendar (email index), response (index into RESPONSES)
+
+Events are written in id order, the other tables refer to them by id. The manifest is written last,
+a directory without one is an interrupted export"""
+import json
+import mmap
+import sys
+from array import array
+from datetime import datetime, timezone
+from pathlib import Path
+from django.db import connection, transaction
+from .models import Attendee, Calendar, Event
+from .utils import is_recruiting
+
+VERSION = 1
+
+# array typecodes of the columns, the manifest records them as numpy dtypes
+TABLES = {
+    "events": {"id": "q", "start": "q", "duration": "i", "organizer": "i", "flags": "B"},
+    "links": {"event": "q", "calendar": "i"},
+    "attendees": {"event": "q", "calendar": "i", "response": "B"},
+}
+
+# Bits of the events' flags column
+ALL_DAY = 1
+CANCELLED = 2
+RECRUITING = 4
+# A recurring master, its occurrences aren't in the snapshot (AUDIT_EXPAND_RECURRING off)
+RECURRING = 8
+
+RESPONSES = ["needsAction", "declined", "tentative", "accepted"]
+# Response statuses the Calendar API may add later
+OTHER_RESPONSE = 255
+
+
+def _dtype(code: str) -> str:
+    order = "<" if sys.byteorder == "little" else ">"
+    return f"{order}i{array(code).itemsize}" if code != "B" else "|u1"
+
+
+class _TableWriter:
+    """Appends rows to the column files of a table"""
+
+    def __init__(self, directory: Path, table: str) -> None:
+        self.columns = TABLES[table]
+        self.files = [open(directory / f"{table}.{name}.bin", "wb") for name in self.columns]
+        self.rows = 0
+
+    def write(self, rows: list[tuple]) -> None:
+        for file, code, values in zip(self.files, self.columns.values(), zip(*rows)):
+            array(code, values).tofile(file)
+        self.rows += len(rows)
+
+    def close(self) -> None:
+        for file in self.files:
+            file.close()
+
+
+def _chunks(queryset, chunk_size: int):
+    """Streams the queryset (with a server-side cursor where the database has them) in lists of chunk_size"""
+    chunk = []
+    for row in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _flags(all_day: bool, status: str, summary: str, recurrence) -> int:
+    flags = ALL_DAY if all_day else 0
+    if status == "cancelled":
+        flags |= CANCELLED
+    if is_recruiting(summary):
+        flags |= RECRUITING
+    if recurrence:
+        flags |= RECURRING
+    return flags
+
+
+@transaction.atomic
+def export(path, chunk_size=2000) -> dict:
+    """Writes a snapshot of every event and attendee to the directory at path, returning its manifest.
+    Every table is read from the same snapshot of the db, so rows committed by concurrent syncs
+    can't show up in some tables and not in others"""
+    # Postgres' default READ COMMITTED gives each query its own snapshot. The isolation level can only be set
+    # before the transaction's first query, so not when the export runs inside an outer transaction
+    if connection.vendor == "postgresql" and len(connection.atomic_blocks) == 1:
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+    directory = Path(path)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / "manifest.json").unlink(missing_ok=True)
+
+    emails = []
+    index = {}
+    for pk, email in Calendar.objects.order_by("pk").values_list("pk", "email").iterator(chunk_size=chunk_size):
+        index[pk] = len(emails)
+        emails.append(email)
+    (directory / "emails.txt").write_text("".join(f"{email}\n" for email in emails))
+
+    responses = {status: i for i, status in enumerate(RESPONSES)}
+    rows = {}
+
+    writer = _TableWriter(directory, "events")
+    events = Event.objects.order_by("pk").values_list(
+        "pk", "start", "duration", "organizer_id", "all_day", "status", "summary", "recurrence"
+    )
+    for chunk in _chunks(events, chunk_size):
+        writer.write(
+            [
+                (
+                    pk,
+                    int(start.timestamp()),
+                    int(duration.total_seconds()),
+                    index[organizer_id],
+                    _flags(all_day, status, summary, recurrence),
+                )
+                for pk, start, duration, organizer_id, all_day, status, summary, recurrence in chunk
+            ]
+        )
+    writer.close()
+    rows["events"] = writer.rows
+
+    writer = _TableWriter(directory, "links")
+    links = Event.calendars.through.objects.order_by("event_id", "calendar_id")
+    for chunk in _chunks(links.values_list("event_id", "calendar_id"), chunk_size):
+        writer.write([(event_id, index[calendar_id]) for event_id, calendar_id in chunk])
+    writer.close()
+    rows["links"] = writer.rows
+
+    writer = _TableWriter(directory, "attendees")
+    attendees = Attendee.objects.order_by("event_id", "calendar_id")
+    for chunk in _chunks(attendees.values_list("event_id", "calendar_id", "response_status"), chunk_size):
+        writer.write(
+            [
+                (event_id, index[calendar_id], responses.get(response, OTHER_RESPONSE))
+                for event_id, calendar_id, response in chunk
+            ]
+        )
+    writer.close()
+    rows["attendees"] = writer.rows
+
+    manifest = {
+        "version": VERSION,
+        "exported_at": datetime.now(timezone.utc).isoformat(),
+        "byteorder": sys.byteorder,
+        "emails": len(emails),
+        "rows": rows,
+        "columns": {
+            table: {name: _dtype(code) for name, code in columns.items()} for table, columns in TABLES.items()
+        },
+    }
+    (directory / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+class Snapshot:
+    """Reads a snapshot written by export. Columns are memory-mapped, only the pages that are
+    read are loaded and the operating system can drop them again under memory pressure"""
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        manifest = self.path / "manifest.json"
+        if not manifest.exists():
+            raise ValueError(f"{self.path} isn't a complete snapshot")
+        self.manifest = json.loads(manifest.read_text())
+        if self.manifest["version"] != VERSION:
+            raise ValueError(f"Unsupported snapshot version {self.manifest['version']}")
+        if self.manifest["byteorder"] != sys.byteorder:
+            raise ValueError(f"The snapshot was written on a {self.manifest['byteorder']}-endian machine")
+
+    @property
+    def emails(self) -> list[str]:
+        """The email of each email index"""
+        return (self.path / "emails.txt").read_text().splitlines()
+
+    def column(self, table: str, name: str) -> memoryview:
+        """The column as a read-only memoryview of integers over the mapped file"""
+        code = TABLES[table][name]
+        with open(self.path / f"{table}.{name}.bin", "rb") as file:
+            if not self.manifest["rows"][table]:
+                return memoryview(b"").cast(code)
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(data).cast(code)
+
+    def rows(self, table: str):
+        """Iterates over the rows of the table as tuples of its columns"""
+        return zip(*(self.column(table, name) for name in TABLES[table]))
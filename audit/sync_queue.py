@@ -0,0 +1,133 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, connection
+from .models import Calendar
+from .calendar_manager import CalendarManager
+
+logger = logging.getLogger(__name__)
+
+
+def sync_calendar(calendar_id: int) -> bool:
+    """Runs an incremental sync of the calendar as one of the users that can read it.
+    Returns False if another process was already syncing it"""
+    calendar = Calendar.objects.get(pk=calendar_id)
+    user = calendar.readers.select_related("primary_calendar").first()
+    manager = CalendarManager(user, calendar=calendar, interactive=False)
+    return manager.sync_events(full_sync=False, backfill=True)
+
+
+class SyncQueue:
+    """Local-process queue of calendar syncs drained by a pool of worker threads.
+    Syncs are keyed by calendar and single-flight: a request for a calendar that is already waiting
+    in the queue (or its debounce window) is coalesced into the pending sync, and requests made while
+    the calendar is syncing collapse into at most one follow-up sync once it finishes.
+    Across processes a calendar is claimed in the db, a sync skipped because another process holds
+    the calendar is retried after retry_delay so the change that requested it isn't lost"""
+
+    def __init__(self, max_workers: int, debounce: float = 0, retry_delay: float = 30) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="calendar-sync")
+        self.debounce = debounce
+        self.retry_delay = retry_delay
+        self._pending = set()
+        self._running = set()
+        self._follow_up = set()
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, calendar_id: int) -> bool:
+        """Queues a sync of the calendar, returns False if it was coalesced into one already scheduled"""
+        with self._lock:
+            if calendar_id in self._pending:
+                return False
+            if calendar_id in self._running:
+                # The running sync may have listed the calendar before this change was made
+                if calendar_id in self._follow_up:
+                    return False
+                self._follow_up.add(calendar_id)
+                return True
+            self._pending.add(calendar_id)
+
+            if self.debounce:
+                timer = threading.Timer(self.debounce, self._submit, args=(calendar_id,))
+                timer.daemon = True
+                self._timers[calendar_id] = timer
+                timer.start()
+                return True
+
+        self._submit(calendar_id)
+        return True
+
+    def _submit(self, calendar_id: int) -> None:
+        with self._lock:
+            self._timers.pop(calendar_id, None)
+        self._executor.submit(self._run, calendar_id)
+
+    def _run(self, calendar_id: int) -> None:
+        # Once started, any new notification needs a new sync to pick up its changes
+        with self._lock:
+            self._pending.discard(calendar_id)
+            self._running.add(calendar_id)
+
+        close_old_connections()
+        skipped = False
+        try:
+            skipped = sync_calendar(calendar_id) is False
+        except Exception:
+            logger.exception("Background sync failed for calendar %s", calendar_id)
+        finally:
+            # Worker threads are long lived, don't leave their connection open between jobs
+            connection.close()
+            with self._lock:
+                self._running.discard(calendar_id)
+                follow_up = calendar_id in self._follow_up
+                self._follow_up.discard(calendar_id)
+
+        if follow_up:
+            self.enqueue(calendar_id)
+        elif skipped:
+            self._retry_later(calendar_id)
+
+    def _retry_later(self, calendar_id: int) -> None:
+        with self._lock:
+            if calendar_id in self._timers:
+                return
+            timer = threading.Timer(self.retry_delay, self._retry, args=(calendar_id,))
+            timer.daemon = True
+            self._timers[calendar_id] = timer
+        timer.start()
+
+    def _retry(self, calendar_id: int) -> None:
+        with self._lock:
+            self._timers.pop(calendar_id, None)
+        self.enqueue(calendar_id)
+
+    def shutdown(self, wait=True) -> None:
+        with self._lock:
+            timers = list(self._timers.values())
+            self._timers.clear()
+        for timer in timers:
+            timer.cancel()
+        self._executor.shutdown(wait=wait)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> SyncQueue:
+    """Returns the process wide sync queue, starting it on first use"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = SyncQueue(
+                max_workers=getattr(settings, "AUDIT_SYNC_WORKERS", 2),
+                debounce=getattr(settings, "AUDIT_SYNC_DEBOUNCE", 0),
+                retry_delay=getattr(settings, "AUDIT_SYNC_CLAIM_RETRY", 30),
+            )
+        return _queue
+
+
+def enqueue_sync(calendar_id: int) -> bool:
+    return get_queue().enqueue(calendar_id)
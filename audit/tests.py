@@ -1,15 +1,42 @@
-from django.test import TestCase
+import importlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock, skipUnless
+from django.test import SimpleTestCase, TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
 import pytz
 from .utils import to_dt
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from django.urls import reverse
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from .models import *
 from .event_builder import EventBuilder
+from .calendar_manager import CalendarManager, LoginRequired, SyncStats
+from .sync_queue import SyncQueue
+from .fleet import FleetSync, renew_watches
+from googleapiclient.errors import HttpError
+from .service_pool import ServicePool
+from google.oauth2.credentials import Credentials
+from .reports import ReportBuilder, TeamReportBuilder
+from . import rollups
+from .benchmarks import harness
+from .instrumentation import registry
+from . import snapshot
+from .utils import DateUtil
+from dateutil.relativedelta import relativedelta
 
 # Create your tests here.
 class RfcConversionTests(TestCase):
     @classmethod
     def setUpTestData(cls):
-        cls.rfc_datetime = "2022-01-01T00:00:00-70:00"
+        cls.rfc_datetime = "2022-01-01T00:00:00-07:00"
         cls.rfc_date = "2022-01-01"
         cls.tz = "America/Phoenix"
         cls.output = pytz.timezone(cls.tz).localize(datetime(year=2022, month=1, day=1))
@@ -22,6 +49,12 @@ class RfcConversionTests(TestCase):
         datetime_test = to_dt(self.rfc_datetime, tz=self.tz)
         self.assertEqual(datetime_test, self.output)
 
+    def test_convert_datetime_honours_offset(self):
+        for rfc_datetime in ("2022-01-01T07:00:00Z", "2022-01-01T07:00:00.000Z", "2022-01-01T02:00:00-05:00"):
+            datetime_test = to_dt(rfc_datetime, tz=self.tz)
+            self.assertEqual(datetime_test, self.output)
+            self.assertEqual(datetime_test.utcoffset(), timedelta(hours=-7))
+
 
 # Create your tests here.
 class EventBuilderTests(TestCase):
@@ -32,8 +65,8 @@ class EventBuilderTests(TestCase):
             "status": "confirmed",
             "summary": "Test Event",
             "eventType": "default",
-            "start": {"dateTime": "2022-01-01T00:00:00-70:00"},
-            "end": {"dateTime": "2022-01-01T12:00:00-70:00"},
+            "start": {"dateTime": "2022-01-01T00:00:00-07:00"},
+            "end": {"dateTime": "2022-01-01T12:00:00-07:00"},
             "organizer": {"email": "ehansen8@wisc.edu"},
             "attendees": [
                 {"email": "ehansen8@wisc.edu", "responseStatus": "accepted"},
@@ -50,3 +83,1221 @@ class EventBuilderTests(TestCase):
             event = Event.objects.get(google_id=self.event_data["id"])
         except Event.DoesNotExist:
             self.fail("event does not exist")
+
+
+def event_data(g_id, status="confirmed", summary="Test Event", attendees=(), updated=None):
+    """Calendar API data of a one hour event organized by ehansen8@wisc.edu.
+    attendees are the emails of the attendees, who all accepted"""
+    data = {
+        "id": g_id,
+        "status": status,
+        "summary": summary,
+        "eventType": "default",
+        "start": {"dateTime": "2022-01-01T00:00:00-07:00"},
+        "end": {"dateTime": "2022-01-01T01:00:00-07:00"},
+        "organizer": {"email": "ehansen8@wisc.edu"},
+        "attendees": [{"email": email, "responseStatus": "accepted"} for email in attendees],
+    }
+    if updated:
+        data["updated"] = updated
+    return data
+
+
+class EventBuilderBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        pc = Calendar(email="ehansen8@wisc.edu", timezone="America/Phoenix")
+        pc.save()
+        cls.user = User(primary_calendar=pc)
+
+    def _count_queries(self, events_list):
+        with CaptureQueriesContext(connection) as ctx:
+            EventBuilder(user=self.user).save_events(events_list)
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_constant(self):
+        small = [event_data(f"s{i}", attendees=[f"s{i}@wisc.edu"]) for i in range(2)]
+        large = [event_data(f"l{i}", attendees=[f"l{i}@wisc.edu"]) for i in range(50)]
+        self.assertEqual(self._count_queries(small), self._count_queries(large))
+
+    def test_creates_updates_and_deletes(self):
+        builder = EventBuilder(user=self.user)
+        builder.save_events([event_data("a"), event_data("b")])
+        self.assertEqual(Event.objects.count(), 2)
+
+        builder.save_events(
+            [event_data("a", summary="Renamed"), event_data("b", status="cancelled")]
+        )
+        self.assertEqual(Event.objects.get(google_id="a").summary, "Renamed")
+        self.assertFalse(Event.objects.filter(google_id="b").exists())
+        self.assertEqual(self.user.primary_calendar.events.count(), 1)
+
+    def test_rollups_are_maintained(self):
+        builder = EventBuilder(user=self.user)
+        recruiting = event_data("b", summary="Interview")
+        builder.save_events([event_data("a"), recruiting])
+
+        month = MonthlyRollup.objects.get(calendar=self.user.primary_calendar)
+        self.assertEqual(month.meeting_count, 2)
+        self.assertEqual(month.total_duration, timedelta(hours=2))
+        self.assertEqual(month.recruiting_duration, timedelta(hours=1))
+
+        # Moving an event to another month shifts its contribution
+        moved = event_data("a")
+        moved["start"] = {"dateTime": "2022-02-01T00:00:00-07:00"}
+        moved["end"] = {"dateTime": "2022-02-01T02:00:00-07:00"}
+        builder.save_events([moved, event_data("b", status="cancelled")])
+
+        months = MonthlyRollup.objects.filter(calendar=self.user.primary_calendar).order_by("period_start")
+        self.assertEqual(
+            [(m.meeting_count, m.total_duration, m.recruiting_duration) for m in months],
+            [(0, timedelta(), timedelta()), (1, timedelta(hours=2), timedelta())],
+        )
+        self.assertEqual(WeeklyRollup.objects.filter(meeting_count=1).count(), 1)
+
+    def test_attendees_are_diffed(self):
+        builder = EventBuilder(user=self.user)
+        builder.save_events([event_data("a", attendees=["x@wisc.edu", "y@wisc.edu"])])
+        kept = Attendee.objects.get(event__google_id="a", calendar__email="x@wisc.edu")
+
+        changed = event_data("a", attendees=["x@wisc.edu", "z@wisc.edu"])
+        changed["attendees"][0]["responseStatus"] = "declined"
+        builder.save_events([changed])
+
+        attendance = Attendee.objects.filter(event__google_id="a")
+        self.assertEqual(
+            sorted(attendance.values_list("calendar__email", flat=True)), ["x@wisc.edu", "z@wisc.edu"]
+        )
+        kept.refresh_from_db()
+        self.assertEqual(kept.response_status, "declined")
+
+
+class FakeEventsResource:
+    """Stands in for service.events(), serving the given pages in order.
+    Listing with one of the expired sync tokens fails with a 410"""
+
+    def __init__(self, pages: list[dict]) -> None:
+        self.pages = pages
+        self.calls = []
+        self.expired = set()
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("syncToken") in self.expired:
+            self._result = HttpError(mock.Mock(status=410), b"")
+            return self
+        index = int(kwargs["pageToken"] or 0)
+        self._result = self.pages[index]
+        return self
+
+    def execute(self):
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
+class FakeService:
+    def __init__(self, pages: list[dict]) -> None:
+        self.events_resource = FakeEventsResource(pages)
+
+    def events(self):
+        return self.events_resource
+
+
+class CalendarManagerSyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="America/Phoenix")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+
+    def _manager(self, pages):
+        return CalendarManager(self.user, watch_config=False, service=FakeService(pages))
+
+    def test_sync_token_saved_after_final_page(self):
+        pages = [
+            {"items": [event_data("a")], "nextPageToken": "1"},
+            {"items": [event_data("b")], "nextSyncToken": "token"},
+        ]
+        self._manager(pages).sync_events()
+
+        self.pc.refresh_from_db()
+        self.assertEqual(self.pc.sync_token, "token")
+        self.assertIsNone(self.pc.page_token)
+        self.assertEqual(self.pc.events.count(), 2)
+
+    def test_sync_stats(self):
+        pages = [
+            {"items": [event_data("a"), event_data("b")], "nextPageToken": "1"},
+            {"items": [event_data("c")], "nextSyncToken": "token"},
+        ]
+        m = self._manager(pages)
+        m.sync_events()
+        self.assertEqual((m.stats.pages, m.stats.events), (2, 3))
+
+    def test_interrupted_sync_resumes_from_page_token(self):
+        pages = [
+            {"items": [event_data("a")], "nextPageToken": "1"},
+            RuntimeError("connection reset"),
+        ]
+        with self.assertRaises(RuntimeError):
+            self._manager(pages).sync_events()
+
+        self.pc.refresh_from_db()
+        self.assertIsNone(self.pc.sync_token)
+        self.assertEqual(self.pc.page_token, "1")
+        self.assertEqual(self.pc.synced_events, 1)
+        self.assertEqual(self.pc.events.count(), 1)
+
+        pages[1] = {"items": [event_data("b")], "nextSyncToken": "token"}
+        m = self._manager(pages)
+        m.sync_events()
+        self.assertEqual(m.service.events_resource.calls[0]["pageToken"], "1")
+        self.assertEqual(self.pc.events.count(), 2)
+
+    @override_settings(AUDIT_INITIAL_SYNC_PAST=None, AUDIT_INITIAL_SYNC_FUTURE=None)
+    def test_expired_sync_token_resyncs_without_clearing(self):
+        EventBuilder(self.user).save_events([event_data("a"), event_data("b")])
+        kept = Event.objects.get(google_id="a")
+        self.pc.sync_token = "old"
+        self.pc.save()
+
+        pages = [{"items": [event_data("a"), event_data("c")], "nextSyncToken": "new"}]
+        m = self._manager(pages)
+        m.service.events_resource.expired.add("old")
+        m.sync_events()
+
+        self.pc.refresh_from_db()
+        self.assertEqual((self.pc.sync_token, self.pc.resyncing), ("new", False))
+        self.assertEqual(sorted(self.pc.events.values_list("google_id", flat=True)), ["a", "c"])
+        # Events the listing returned unchanged are kept rather than reinserted
+        self.assertEqual(self.pc.events.get(google_id="a").pk, kept.pk)
+        self.assertEqual(MonthlyRollup.objects.get(calendar=self.pc).meeting_count, 2)
+
+    @override_settings(AUDIT_INITIAL_SYNC_PAST=None, AUDIT_INITIAL_SYNC_FUTURE=None)
+    def test_interrupted_resync_starts_over(self):
+        EventBuilder(self.user).save_events([event_data("a"), event_data("b")])
+        self.pc.resyncing = True
+        self.pc.page_token = "1"
+        self.pc.save()
+
+        pages = [
+            {"items": [event_data("a")], "nextPageToken": "1"},
+            {"items": [event_data("c")], "nextSyncToken": "token"},
+        ]
+        m = self._manager(pages)
+        m.sync_events()
+
+        self.assertIsNone(m.service.events_resource.calls[0]["pageToken"])
+        self.assertEqual(sorted(self.pc.events.values_list("google_id", flat=True)), ["a", "c"])
+        self.assertFalse(self.pc.resyncing)
+
+    def test_calendar_claimed_elsewhere_is_skipped(self):
+        Calendar.objects.filter(pk=self.pc.pk).update(syncing_since=datetime.now(timezone.utc))
+        m = self._manager([{"items": [event_data("a")], "nextSyncToken": "token"}])
+
+        self.assertFalse(m.sync_events())
+        self.assertEqual(m.service.events_resource.calls, [])
+
+    def test_stale_claim_is_taken_over_and_released(self):
+        stale = datetime.now(timezone.utc) - settings.AUDIT_SYNC_CLAIM_TIMEOUT - timedelta(minutes=1)
+        Calendar.objects.filter(pk=self.pc.pk).update(syncing_since=stale)
+        m = self._manager([{"items": [event_data("a")], "nextSyncToken": "token"}])
+
+        self.assertTrue(m.sync_events())
+        self.pc.refresh_from_db()
+        self.assertEqual(self.pc.sync_token, "token")
+        self.assertIsNone(self.pc.syncing_since)
+
+    def test_claim_is_released_when_sync_fails(self):
+        with self.assertRaises(RuntimeError):
+            self._manager([RuntimeError("connection reset")]).sync_events()
+        self.pc.refresh_from_db()
+        self.assertIsNone(self.pc.syncing_since)
+
+    @override_settings(AUDIT_INITIAL_SYNC_PAST=timedelta(days=120), AUDIT_INITIAL_SYNC_FUTURE=timedelta(days=31))
+    def test_initial_sync_is_windowed(self):
+        pages = [{"items": [event_data("a")], "nextSyncToken": "token"}]
+        m = self._manager(pages)
+        m.sync_events()
+
+        first = m.service.events_resource.calls[0]
+        self.assertNotIn("syncToken", first)
+        self.assertEqual(first["timeMin"], self.pc.synced_from.isoformat())
+        self.assertEqual(first["timeMax"], self.pc.synced_until.isoformat())
+        self.assertTrue(self.pc.is_windowed())
+
+        # Incremental syncs only pass the sync token, which also covers events outside the window
+        m.sync_events()
+        second = m.service.events_resource.calls[1]
+        self.assertEqual(second["syncToken"], "token")
+        self.assertNotIn("timeMin", second)
+        self.assertNotIn("timeMax", second)
+
+    @override_settings(AUDIT_INITIAL_SYNC_PAST=timedelta(days=120), AUDIT_INITIAL_SYNC_FUTURE=timedelta(days=31))
+    def test_backfill_fetches_history_outside_window(self):
+        pages = [{"items": [event_data("a")], "nextSyncToken": "token"}]
+        m = self._manager(pages)
+        m.sync_events(backfill=True)
+
+        initial, before, after = m.service.events_resource.calls
+        self.assertEqual(before["timeMax"], initial["timeMin"])
+        self.assertNotIn("timeMin", before)
+        self.assertEqual(after["timeMin"], initial["timeMax"])
+        self.assertNotIn("timeMax", after)
+        self.assertNotIn("syncToken", after)
+
+        self.pc.refresh_from_db()
+        self.assertFalse(self.pc.is_windowed())
+        self.assertEqual(self.pc.sync_token, "token")
+
+    @override_settings(AUDIT_INITIAL_SYNC_PAST=timedelta(days=120), AUDIT_INITIAL_SYNC_FUTURE=timedelta(days=31))
+    def test_backfill_keeps_the_claim_alive(self):
+        m = self._manager([{"items": [event_data("a")], "nextSyncToken": "token"}])
+        resource = m.service.events_resource
+        claims = []
+
+        def list_events(**kwargs):
+            claims.append(Calendar.objects.get(pk=self.pc.pk).syncing_since)
+            return FakeEventsResource.list(resource, **kwargs)
+
+        with mock.patch.object(resource, "list", side_effect=list_events):
+            m.sync_events(backfill=True)
+
+        initial, before, after = claims
+        self.assertIsNotNone(initial)
+        # Refreshed once the page before the window was saved
+        self.assertGreater(after, before)
+
+    @override_settings(AUDIT_INITIAL_SYNC_PAST=timedelta(days=120), AUDIT_INITIAL_SYNC_FUTURE=timedelta(days=31))
+    def test_prefetched_first_page_keeps_its_window(self):
+        pages = [
+            {"items": [event_data("a")], "nextPageToken": "1"},
+            {"items": [event_data("b")], "nextSyncToken": "token"},
+        ]
+        m = self._manager(pages)
+        # As a batched fleet sync does
+        m.prepare_sync()
+        window = (self.pc.synced_from, self.pc.synced_until)
+        first_page = m.list_request().execute()
+        m.sync_events(first_page=first_page, backfill=True)
+
+        initial, continuation, *backfill = m.service.events_resource.calls
+        self.assertEqual((initial["timeMin"], initial["timeMax"]), tuple(dt.isoformat() for dt in window))
+        self.assertEqual(continuation["timeMin"], initial["timeMin"])
+        self.assertEqual(continuation["timeMax"], initial["timeMax"])
+        # The backfill picks up exactly where the window of the first page ends
+        self.assertIn(window[0].isoformat(), [call.get("timeMax") for call in backfill])
+        self.assertIn(window[1].isoformat(), [call.get("timeMin") for call in backfill])
+
+    @override_settings(AUDIT_INITIAL_SYNC_PAST=None, AUDIT_INITIAL_SYNC_FUTURE=None)
+    def test_unbounded_initial_sync(self):
+        pages = [{"items": [event_data("a")], "nextSyncToken": "token"}]
+        m = self._manager(pages)
+        m.sync_events(backfill=True)
+
+        (call,) = m.service.events_resource.calls
+        self.assertNotIn("timeMin", call)
+        self.assertNotIn("timeMax", call)
+
+
+class SyncQueueTests(SimpleTestCase):
+    def test_pending_syncs_are_coalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fake_sync(calendar_id):
+            calls.append(calendar_id)
+            started.set()
+            release.wait(timeout=5)
+
+        queue = SyncQueue(max_workers=1)
+        with mock.patch("audit.sync_queue.sync_calendar", fake_sync):
+            self.assertTrue(queue.enqueue(1))
+            started.wait(timeout=5)
+            # The worker is busy so these all wait in the queue
+            self.assertTrue(queue.enqueue(2))
+            self.assertFalse(queue.enqueue(2))
+            self.assertFalse(queue.enqueue(2))
+            release.set()
+            queue.shutdown()
+
+        self.assertEqual(calls, [1, 2])
+
+    def test_notifications_during_sync_collapse_into_one_follow_up(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fake_sync(calendar_id):
+            calls.append(calendar_id)
+            started.set()
+            release.wait(timeout=5)
+
+        queue = SyncQueue(max_workers=2)
+        with mock.patch("audit.sync_queue.sync_calendar", fake_sync):
+            self.assertTrue(queue.enqueue(1))
+            started.wait(timeout=5)
+            # Never a second concurrent sync of the same calendar, only one follow-up
+            self.assertTrue(queue.enqueue(1))
+            self.assertFalse(queue.enqueue(1))
+            self.assertEqual(calls, [1])
+            release.set()
+            # Give the follow-up time to be submitted before the pool shuts down
+            for _ in range(50):
+                if len(calls) == 2:
+                    break
+                time.sleep(0.01)
+            queue.shutdown()
+
+        self.assertEqual(calls, [1, 1])
+
+    def test_debounced_notifications_coalesce(self):
+        calls = []
+        queue = SyncQueue(max_workers=1, debounce=0.05)
+        with mock.patch("audit.sync_queue.sync_calendar", calls.append):
+            self.assertTrue(queue.enqueue(1))
+            self.assertFalse(queue.enqueue(1))
+            time.sleep(0.2)
+            queue.shutdown()
+
+        self.assertEqual(calls, [1])
+
+    def test_sync_claimed_by_another_process_is_retried(self):
+        results = [False, True]
+        calls = []
+
+        def fake_sync(calendar_id):
+            calls.append(calendar_id)
+            return results.pop(0)
+
+        queue = SyncQueue(max_workers=1, retry_delay=0.05)
+        with mock.patch("audit.sync_queue.sync_calendar", fake_sync):
+            queue.enqueue(1)
+            for _ in range(50):
+                if len(calls) == 2:
+                    break
+                time.sleep(0.01)
+            queue.shutdown()
+
+        self.assertEqual(calls, [1, 1])
+
+
+class IndexFreshnessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="America/Phoenix")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def _get_index(self, last_synced):
+        self.pc.last_synced = last_synced
+        self.pc.save()
+        with mock.patch("audit.views.CalendarManager") as manager, mock.patch(
+            "audit.views.enqueue_sync"
+        ) as enqueue:
+            response = self.client.get(reverse("audit:index"))
+        self.assertEqual(response.status_code, 200)
+        manager.assert_not_called()
+        return enqueue
+
+    def test_fresh_calendar_renders_without_sync(self):
+        enqueue = self._get_index(datetime.now(timezone.utc))
+        enqueue.assert_not_called()
+
+    def test_stale_calendar_schedules_background_sync(self):
+        enqueue = self._get_index(datetime.now(timezone.utc) - timedelta(days=1))
+        enqueue.assert_called_once_with(self.pc.pk)
+
+
+class WatchNotificationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="America/Phoenix")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+        cls.user.calendars.add(cls.pc)
+        cls.channel = WatchChannel.objects.create(
+            id=uuid.uuid1(), resource_id="r", expiration=datetime.now(timezone.utc), calendar=cls.pc
+        )
+
+    def _notify(self, message_number, channel_id=None):
+        with mock.patch("audit.views.enqueue_sync") as enqueue:
+            response = self.client.post(
+                reverse("audit:watch"),
+                HTTP_X_GOOG_RESOURCE_STATE="exists",
+                HTTP_X_GOOG_CHANNEL_ID=str(channel_id or self.channel.id),
+                HTTP_X_GOOG_MESSAGE_NUMBER=str(message_number),
+            )
+        self.assertEqual(response.status_code, 200)
+        return enqueue
+
+    def test_stale_and_duplicate_messages_are_dropped(self):
+        self._notify(5).assert_called_once_with(self.pc.pk)
+        self._notify(5).assert_not_called()
+        self._notify(4).assert_not_called()
+        self._notify(6).assert_called_once_with(self.pc.pk)
+
+    def test_unknown_channel_is_dropped(self):
+        self._notify(5, channel_id=uuid.uuid1()).assert_not_called()
+
+
+class ReportBuilderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="UTC")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+        other = Calendar.objects.create(email="testuser@wisc.edu")
+
+        this_month = DateUtil(tz="UTC").this_month
+        cls.months = [this_month - relativedelta(months=i) for i in (2, 1)]
+        for month, count in zip(cls.months, (1, 2)):
+            for i in range(count):
+                event = Event.objects.create(
+                    google_id=f"{month.month}-{i}",
+                    organizer=cls.pc,
+                    status="confirmed",
+                    summary="Interview" if i else "Standup",
+                    event_type="default",
+                    start=month + timedelta(days=7, hours=i),
+                    duration=timedelta(hours=1),
+                )
+                event.calendars.add(cls.pc)
+                Attendee.objects.create(event=event, calendar=other, response_status="accepted")
+                Attendee.objects.create(event=event, calendar=cls.pc, response_status="accepted")
+        rollups.rebuild(cls.pc)
+
+    def test_metrics(self):
+        rb = ReportBuilder(self.user, num_months=3)
+        with self.assertNumQueries(5):
+            time_per_month = rb.get_time_per_month()
+            least, most = rb.get_most_and_least_meetings()
+            light_week, busy_week = rb.get_busiest_weeks()
+            avg_meetings = rb.get_avg_meetings_week()
+            recruiting = rb.get_time_recruiting()
+            collaborators = rb.get_top_collaborators(num_people=3)
+
+        self.assertEqual(
+            time_per_month,
+            [
+                {"month": self.months[0].month, "time": timedelta(hours=1)},
+                {"month": self.months[1].month, "time": timedelta(hours=2)},
+            ],
+        )
+        self.assertEqual(least, {"month": self.months[0].month, "count": 1})
+        self.assertEqual(most, {"month": self.months[1].month, "count": 2})
+        self.assertEqual(busy_week["time"], timedelta(hours=2))
+        self.assertEqual(light_week["time"], timedelta(hours=1))
+        self.assertEqual(avg_meetings, {"avg": 1.5})
+        self.assertEqual(recruiting, {"time": timedelta(hours=1)})
+        self.assertEqual(collaborators, [{"email": "testuser@wisc.edu", "count": 3}])
+
+    def test_collaborator_trend(self):
+        rb = ReportBuilder(self.user, num_months=3)
+        self.assertEqual(
+            rb.get_collaborator_trend("testuser@wisc.edu"),
+            [{"month": self.months[0].month, "count": 1}, {"month": self.months[1].month, "count": 2}],
+        )
+        self.assertEqual(rb.get_collaborator_trend("nobody@wisc.edu"), [])
+
+    def test_top_collaborators_include_current_month(self):
+        other = Calendar.objects.get(email="testuser@wisc.edu")
+        event = Event.objects.create(
+            google_id="today",
+            organizer=self.pc,
+            status="confirmed",
+            event_type="default",
+            start=DateUtil(tz="UTC").this_month,
+            duration=timedelta(hours=1),
+        )
+        event.calendars.add(self.pc)
+        Attendee.objects.create(event=event, calendar=other, response_status="accepted")
+
+        collaborators = ReportBuilder(self.user, num_months=3).get_top_collaborators(num_people=3)
+        self.assertEqual(collaborators, [{"email": "testuser@wisc.edu", "count": 4}])
+
+    def test_report_cache(self):
+        cache.clear()
+        self.pc.refresh_from_db()
+        ReportBuilder(self.user, num_months=3).get_report()
+        with self.assertNumQueries(0):
+            ReportBuilder(self.user, num_months=3).get_report()
+
+        # A page with nothing to write leaves the cached report valid
+        EventBuilder(self.user).save_events([{"id": "missing", "status": "cancelled"}])
+        self.pc.refresh_from_db()
+        with self.assertNumQueries(0):
+            ReportBuilder(self.user, num_months=3).get_report()
+
+        event = Event.objects.filter(calendars=self.pc).first()
+        EventBuilder(self.user).save_events(
+            [{"id": event.google_id, "status": "cancelled"}]
+        )
+        self.pc.refresh_from_db()
+        report = ReportBuilder(self.user, num_months=3).get_report()
+        self.assertEqual(sum((m["time"] for m in report["time_per_month"]), timedelta()), timedelta(hours=2))
+
+    def test_rebuild_invalidates_cached_report(self):
+        cache.clear()
+        self.pc.refresh_from_db()
+        ReportBuilder(self.user, num_months=3).get_report()
+
+        # Rollups that went wrong (e.g. written by an older version) are fixed by rebuilding them
+        Event.objects.filter(calendars=self.pc).update(duration=timedelta(hours=2))
+        rollups.rebuild(self.pc)
+        self.pc.refresh_from_db()
+        report = ReportBuilder(self.user, num_months=3).get_report()
+        self.assertEqual(sum((m["time"] for m in report["time_per_month"]), timedelta()), timedelta(hours=6))
+
+
+class RollupTimezoneTests(TestCase):
+    """Rollups are bucketed in each calendar's timezone, the one its report windows are cut in"""
+
+    def _save(self, tz, start):
+        calendar = Calendar.objects.create(email=f"{tz}@wisc.edu", timezone=tz)
+        user = User.objects.create(username=tz, primary_calendar=calendar)
+        EventBuilder(user).save_events(
+            [
+                {
+                    "id": "interview",
+                    "status": "confirmed",
+                    "summary": "Interview",
+                    "eventType": "default",
+                    "start": {"dateTime": start.isoformat()},
+                    "end": {"dateTime": (start + timedelta(hours=1)).isoformat()},
+                    "organizer": {"email": calendar.email},
+                    "attendees": [{"email": "a@x.com", "responseStatus": "accepted"}],
+                }
+            ]
+        )
+        return user
+
+    def test_start_of_month_east_of_utc(self):
+        # 00:30 on the 1st in Berlin is still the previous month in UTC
+        month = DateUtil(tz="Europe/Berlin").this_month - relativedelta(months=1)
+        user = self._save("Europe/Berlin", month + timedelta(minutes=30))
+
+        rb = ReportBuilder(user)
+        self.assertEqual(rb.get_time_per_month(), [{"month": month.month, "time": timedelta(hours=1)}])
+        self.assertEqual(rb.get_time_recruiting(), {"time": timedelta(hours=1)})
+        self.assertEqual(rb.get_top_collaborators(num_people=3), [{"email": "a@x.com", "count": 1}])
+        self.assertEqual(rb.get_collaborator_trend("a@x.com"), [{"month": month.month, "count": 1}])
+
+    def test_end_of_month_west_of_utc(self):
+        # 23:30 on the last day in Phoenix is already the next month in UTC
+        month = DateUtil(tz="America/Phoenix").this_month - relativedelta(months=1)
+        user = self._save("America/Phoenix", month - timedelta(minutes=30))
+
+        rb = ReportBuilder(user)
+        previous = (month - relativedelta(months=1)).month
+        self.assertEqual(rb.get_time_per_month(), [{"month": previous, "time": timedelta(hours=1)}])
+        self.assertEqual(rb.get_time_recruiting(), {"time": timedelta(hours=1)})
+        self.assertEqual(rb.get_top_collaborators(num_people=3), [{"email": "a@x.com", "count": 1}])
+        self.assertEqual(rb.get_collaborator_trend("a@x.com"), [{"month": previous, "count": 1}])
+
+    def test_migration_backfills_rollups_and_collaborations(self):
+        month = DateUtil(tz="Europe/Berlin").this_month - relativedelta(months=1)
+        user = self._save("Europe/Berlin", month + timedelta(minutes=30))
+        MonthlyRollup.objects.all().delete()
+        Collaboration.objects.all().delete()
+
+        # The models as of the migration
+        state = MigrationLoader(connection).project_state(("audit", "0026_rebuild_rollups"))
+        importlib.import_module("audit.migrations.0026_rebuild_rollups").rebuild_rollups(state.apps, None)
+        rb = ReportBuilder(user)
+        self.assertEqual(rb.get_time_per_month(), [{"month": month.month, "time": timedelta(hours=1)}])
+        self.assertEqual(rb.get_collaborator_trend("a@x.com"), [{"month": month.month, "count": 1}])
+
+        # Same rows as rollups.rebuild
+        def rows():
+            return [
+                sorted(model.objects.values_list(*(f.attname for f in model._meta.fields if not f.primary_key)))
+                for model in (WeeklyRollup, MonthlyRollup, Collaboration)
+            ]
+
+        migrated = rows()
+        rollups.rebuild(user.primary_calendar)
+        self.assertEqual(rows(), migrated)
+
+
+class TeamReportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.calendars = [Calendar.objects.create(email=f"user{i}@wisc.edu", timezone="UTC") for i in range(3)]
+        cls.users = [
+            User.objects.create(username=f"user{i}", primary_calendar=calendar)
+            for i, calendar in enumerate(cls.calendars)
+        ]
+
+        this_month = DateUtil(tz="UTC").this_month
+        for n, calendar in enumerate(cls.calendars):
+            for i, start in enumerate(
+                [this_month - relativedelta(months=2), this_month - relativedelta(months=1), this_month]
+            ):
+                for j in range(n + i):
+                    event = Event.objects.create(
+                        google_id=f"{n}-{i}-{j}",
+                        organizer=calendar,
+                        status="confirmed",
+                        summary="Interview" if j else "Standup",
+                        event_type="default",
+                        start=start + timedelta(hours=j),
+                        duration=timedelta(hours=1),
+                    )
+                    event.calendars.add(calendar)
+            rollups.rebuild(calendar)
+
+    def test_matches_report_builder(self):
+        cache.clear()
+        with self.assertNumQueries(3):
+            report = TeamReportBuilder(self.calendars).get_report()
+
+        for user in self.users:
+            expected = ReportBuilder(user).get_report()
+            del expected["top_collaborators"]
+            self.assertEqual(report["calendars"][user.primary_calendar.email], expected)
+
+        months = [m["month"] for m in report["team"]]
+        self.assertEqual(len(months), 2)
+        self.assertEqual([m["count"] for m in report["team"]], [0 + 1 + 2, 1 + 2 + 3])
+
+    def test_calendar_without_timezone(self):
+        # Calendars only seen as organizers or attendees have no timezone
+        report = TeamReportBuilder([Calendar.objects.create(email="a@x.com")]).get_report()
+        self.assertEqual(report["calendars"]["a@x.com"]["time_per_month"], [])
+
+
+class DuplicateRowsMigrationTests(TestCase):
+    def test_duplicate_events_hand_their_calendars_and_attendees_over(self):
+        a, b, c, d = [Calendar.objects.create(email=f"{name}@wisc.edu") for name in "abcd"]
+        events = [
+            Event.objects.create(
+                google_id="dup",
+                organizer=organizer,
+                status="confirmed",
+                event_type="default",
+                start=datetime(2022, 1, 3, 9, tzinfo=timezone.utc),
+                duration=timedelta(hours=1),
+            )
+            for organizer in (a, b, c)
+        ]
+        keep, *others = events
+        keep.calendars.add(a)
+        for event in others:
+            event.calendars.add(a, b)
+        Attendee.objects.create(event=keep, calendar=c, response_status="accepted")
+        Attendee.objects.create(event=others[0], calendar=c, response_status="declined")
+        for event in others:
+            Attendee.objects.create(event=event, calendar=d, response_status="accepted")
+
+        # The models as of the migration
+        state = MigrationLoader(connection).project_state(("audit", "0018_remove_duplicate_rows"))
+        importlib.import_module("audit.migrations.0018_remove_duplicate_rows").remove_duplicate_rows(
+            state.apps, None
+        )
+
+        self.assertEqual(list(Event.objects.values_list("pk", flat=True)), [keep.pk])
+        self.assertEqual(sorted(keep.calendars.values_list("email", flat=True)), ["a@wisc.edu", "b@wisc.edu"])
+        self.assertEqual(
+            sorted(Attendee.objects.values_list("calendar__email", "response_status")),
+            [("c@wisc.edu", "accepted"), ("d@wisc.edu", "accepted")],
+        )
+
+
+@tag("slow")
+class QueryPlanTests(TestCase):
+    """Regression checks that the sync and report hot paths keep using indexes once the
+    events table is large enough for the planner to prefer them"""
+
+    NUM_EVENTS = 100_000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="UTC")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+        others = Calendar.objects.bulk_create(
+            [Calendar(email=f"user{i}@wisc.edu") for i in range(100)]
+        )
+
+        start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        events = Event.objects.bulk_create(
+            [
+                Event(
+                    google_id=f"event{i}",
+                    organizer=others[i % len(others)],
+                    status="confirmed",
+                    event_type="default",
+                    all_day=i % 10 == 0,
+                    start=start + timedelta(hours=i),
+                    duration=timedelta(hours=1),
+                )
+                for i in range(cls.NUM_EVENTS)
+            ],
+            batch_size=5000,
+        )
+        through = Event.calendars.through
+        through.objects.bulk_create(
+            [through(event_id=e.pk, calendar_id=cls.pc.pk) for e in events], batch_size=5000
+        )
+        Attendee.objects.bulk_create(
+            [
+                Attendee(event=e, calendar=others[i % len(others)], response_status="accepted")
+                for i, e in enumerate(events)
+            ],
+            batch_size=5000,
+        )
+        for table in ("audit_event", "audit_attendee", "audit_event_calendars"):
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {table}")
+
+    def assertNoSeqScan(self, queryset, table):
+        plan = queryset.explain()
+        if connection.vendor == "postgresql":
+            self.assertNotIn(f"Seq Scan on {table}", plan)
+        elif connection.vendor == "sqlite":
+            # Full table scans show up as "SCAN <table>" without an index
+            for line in plan.splitlines():
+                if f"SCAN {table}" in line:
+                    self.assertIn("INDEX", line, plan)
+
+    def test_upsert_prefetch_uses_index(self):
+        ids = [f"event{i}" for i in range(0, self.NUM_EVENTS, 1000)]
+        self.assertNoSeqScan(Event.objects.filter(google_id__in=ids), "audit_event")
+
+    def test_report_window_uses_index(self):
+        rb = ReportBuilder(self.user, num_months=3)
+        self.assertNoSeqScan(Event.objects.filter(start__range=(rb.time_min, rb.day_max), all_day=False), "audit_event")
+        self.assertNoSeqScan(rb._filter_by_range(), "audit_event")
+
+    def test_attendee_diff_uses_index(self):
+        events = Event.objects.filter(google_id__in=["event1", "event2"])
+        self.assertNoSeqScan(Attendee.objects.filter(event__in=events), "audit_attendee")
+
+    def test_calendar_lookup_uses_index(self):
+        self.assertNoSeqScan(Calendar.objects.filter(email__in=["user1@wisc.edu"]), "audit_calendar")
+
+
+class ServicePoolTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f"user{i}", auth_token=f"token{i}") for i in range(3)]
+
+    def test_services_are_reused_per_user(self):
+        pool = ServicePool(max_size=2)
+        get_creds = mock.Mock(side_effect=lambda: Credentials(token="token"))
+
+        _, service = pool.get(self.users[0], get_creds)
+        _, again = pool.get(self.users[0], get_creds)
+        self.assertIs(service, again)
+        self.assertEqual(get_creds.call_count, 1)
+
+        # A new auth token (e.g. after logging in again) rebuilds the service
+        self.users[0].auth_token = "new token"
+        _, rebuilt = pool.get(self.users[0], get_creds)
+        self.assertIsNot(service, rebuilt)
+
+    def test_background_manager_does_not_start_login(self):
+        user = User.objects.create(username="loggedout")
+        with mock.patch("audit.calendar_manager.InstalledAppFlow") as flow:
+            with self.assertRaises(LoginRequired):
+                CalendarManager(user, watch_config=False, interactive=False)
+        flow.from_client_secrets_file.assert_not_called()
+
+    def test_least_recently_used_is_evicted(self):
+        pool = ServicePool(max_size=2)
+        get_creds = mock.Mock(side_effect=lambda: Credentials(token="token"))
+        for user in (self.users[0], self.users[1], self.users[0], self.users[2]):
+            pool.get(user, get_creds)
+        self.assertEqual(get_creds.call_count, 3)
+
+        pool.get(self.users[0], get_creds)
+        self.assertEqual(get_creds.call_count, 3)
+        pool.get(self.users[1], get_creds)
+        self.assertEqual(get_creds.call_count, 4)
+
+
+class FakeBatch:
+    def __init__(self, callback) -> None:
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            self.callback(request_id, request, None)
+
+
+class FleetSyncTests(SimpleTestCase):
+    def _manager(self, pk):
+        manager = mock.Mock()
+        manager.user.pk = pk
+        manager.stats = SyncStats()
+        manager.list_request.side_effect = lambda page_token: {"items": [], "user": pk}
+        manager.service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback)
+        return manager
+
+    def test_first_pages_are_batched(self):
+        managers = {pk: self._manager(pk) for pk in range(60)}
+        users = [mock.Mock(pk=pk) for pk in managers]
+        with mock.patch("audit.fleet.CalendarManager", side_effect=lambda user, **kw: managers[user.pk]):
+            errors = FleetSync(users, max_workers=4).run()
+
+        self.assertEqual(errors, {})
+        # 60 users fit in two batches
+        batch_calls = sum(m.service.new_batch_http_request.call_count for m in managers.values())
+        self.assertEqual(batch_calls, 2)
+        for pk, manager in managers.items():
+            manager.sync_events.assert_called_once_with(
+                full_sync=False, first_page={"items": [], "user": pk}, backfill=True
+            )
+
+    def test_shared_calendars_are_synced_once(self):
+        primaries = {pk: mock.Mock(pk=pk) for pk in (1, 2)}
+        shared = mock.Mock(pk=3)
+        # The first user can also read the second one's primary calendar
+        readable = {1: [primaries[1], primaries[2], shared], 2: [primaries[2], shared]}
+        built = []
+
+        def build(user, calendar=None, **kwargs):
+            manager = self._manager(user.pk)
+            manager.calendar = calendar or primaries[user.pk]
+            manager.sync_calendar_list.return_value = readable[user.pk]
+            built.append(manager)
+            return manager
+
+        with mock.patch("audit.fleet.CalendarManager", side_effect=build):
+            FleetSync([mock.Mock(pk=1), mock.Mock(pk=2)], all_calendars=True).run()
+
+        synced = [m.calendar.pk for m in built if m.sync_events.called]
+        self.assertEqual(sorted(synced), [1, 2, 3])
+
+    def test_rate_limited_sync_backs_off(self):
+        manager = self._manager(1)
+        rate_limited = HttpError(mock.Mock(status=429), b"")
+        manager.sync_events.side_effect = [rate_limited, None]
+        with mock.patch("audit.fleet.CalendarManager", return_value=manager), mock.patch(
+            "audit.fleet.time.sleep"
+        ) as sleep:
+            fleet = FleetSync([mock.Mock(pk=1)])
+            errors = fleet.run()
+
+        self.assertEqual(errors, {})
+        self.assertEqual(manager.sync_events.call_count, 2)
+        self.assertEqual(len(fleet.stats), 1)
+        sleep.assert_called_once()
+
+
+class SharedEventTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="America/Phoenix")
+        cls.shared = Calendar.objects.create(email="team@wisc.edu", timezone="America/Phoenix")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+        cls.user.calendars.add(cls.pc, cls.shared)
+
+    event = event_data("a", attendees=["testuser@wisc.edu"], updated="2022-01-01T00:00:00.000Z")
+
+    def test_event_seen_on_another_calendar_is_only_linked(self):
+        EventBuilder(self.user).save_events([self.event])
+        with CaptureQueriesContext(connection) as ctx:
+            EventBuilder(self.user, self.shared).save_events([self.event])
+
+        self.assertEqual(Event.objects.count(), 1)
+        self.assertEqual(set(Event.objects.get().calendars.all()), {self.pc, self.shared})
+        self.assertFalse(any(q["sql"].startswith("UPDATE \"audit_event\"") for q in ctx.captured_queries))
+        self.assertEqual(MonthlyRollup.objects.get(calendar=self.shared).meeting_count, 1)
+
+    def test_cancelling_on_one_calendar_keeps_the_shared_event(self):
+        EventBuilder(self.user).save_events([self.event])
+        EventBuilder(self.user, self.shared).save_events([self.event])
+
+        EventBuilder(self.user, self.shared).save_events([{"id": "a", "status": "cancelled"}])
+        self.assertEqual(list(Event.objects.get().calendars.all()), [self.pc])
+        self.assertEqual(MonthlyRollup.objects.get(calendar=self.shared).meeting_count, 0)
+
+        EventBuilder(self.user).save_events([{"id": "a", "status": "cancelled"}])
+        self.assertFalse(Event.objects.exists())
+
+    def test_collaborations_follow_writes(self):
+        def count(email="testuser@wisc.edu", calendar=None):
+            rows = Collaboration.objects.filter(calendar=calendar or self.pc, collaborator__email=email)
+            return sum(rows.values_list("meeting_count", flat=True))
+
+        EventBuilder(self.user).save_events([self.event])
+        self.assertEqual(count(), 1)
+        self.assertEqual(count("ehansen8@wisc.edu"), 0)
+
+        EventBuilder(self.user, self.shared).save_events([self.event])
+        self.assertEqual(count(calendar=self.shared), 1)
+
+        changed = event_data("a", attendees=["other@wisc.edu"], updated="2022-01-02T00:00:00.000Z")
+        EventBuilder(self.user).save_events([changed])
+        self.assertEqual(count(), 0)
+        self.assertEqual(count("other@wisc.edu"), 1)
+        self.assertEqual(count("other@wisc.edu", self.shared), 1)
+
+        EventBuilder(self.user).save_events([{"id": "a", "status": "cancelled"}])
+        self.assertEqual(count("other@wisc.edu"), 0)
+        self.assertEqual(count("other@wisc.edu", self.shared), 1)
+
+        rollups.rebuild(self.shared)
+        self.assertEqual(count("other@wisc.edu", self.shared), 1)
+
+    def test_changed_organizer_replaces_the_old_copy(self):
+        EventBuilder(self.user).save_events([self.event])
+        changed = {**self.event, "organizer": {"email": "team@wisc.edu"}, "updated": "2022-01-02T00:00:00.000Z"}
+        EventBuilder(self.user).save_events([changed])
+
+        organizers = Event.objects.filter(calendars=self.pc).values_list("organizer", flat=True)
+        self.assertEqual(list(organizers), [self.shared.pk])
+        self.assertEqual(Event.objects.count(), 1)
+        self.assertEqual(MonthlyRollup.objects.get(calendar=self.pc).total_duration, timedelta(hours=1))
+
+    def test_newer_event_is_updated(self):
+        EventBuilder(self.user).save_events([self.event])
+        changed = {**self.event, "summary": "Renamed", "updated": "2022-01-02T00:00:00.000Z"}
+        EventBuilder(self.user, self.shared).save_events([changed])
+        self.assertEqual(Event.objects.get().summary, "Renamed")
+
+
+@override_settings(AUDIT_EXPAND_RECURRING=False)
+class RecurringMasterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="UTC")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+        # A full month of the report window
+        cls.month = DateUtil(tz="UTC").this_month - relativedelta(months=2)
+        cls.first = cls.month + timedelta(days=2, hours=9)
+
+    def _time(self, dt):
+        return {"dateTime": dt.strftime("%Y-%m-%dT%H:%M:%S+00:00")}
+
+    def _master(self):
+        return {
+            "id": "standup",
+            "status": "confirmed",
+            "summary": "Standup",
+            "eventType": "default",
+            "start": self._time(self.first),
+            "end": self._time(self.first + timedelta(minutes=30)),
+            "organizer": {"email": "ehansen8@wisc.edu"},
+            "attendees": [{"email": "testuser@wisc.edu", "responseStatus": "accepted"}],
+            "recurrence": ["RRULE:FREQ=DAILY;COUNT=5"],
+        }
+
+    def _cancelled(self, day):
+        start = self.first + timedelta(days=day)
+        return {
+            "id": f"standup_{start:%Y%m%dT%H%M%SZ}",
+            "status": "cancelled",
+            "recurringEventId": "standup",
+            "originalStartTime": self._time(start),
+        }
+
+    def test_master_and_cancelled_exception_are_stored(self):
+        EventBuilder(self.user).save_events([self._master(), self._cancelled(2)])
+
+        master = Event.objects.get(google_id="standup")
+        self.assertEqual(master.recurrence, ["RRULE:FREQ=DAILY;COUNT=5"])
+        exception = Event.objects.get(recurring_event_id="standup")
+        self.assertEqual(exception.status, "cancelled")
+        self.assertEqual(exception.organizer, self.pc)
+        self.assertEqual(exception.original_start, self.first + timedelta(days=2))
+        # Neither is a meeting of its own
+        self.assertFalse(MonthlyRollup.objects.filter(meeting_count__gt=0).exists())
+
+    def test_cancelled_exception_with_unseen_people_is_stored(self):
+        # Exceptions cancelled by an invitee carry the organizer and attendees of the occurrence
+        cancelled = {
+            **self._cancelled(1),
+            "organizer": {"email": "boss@x.com"},
+            "attendees": [{"email": "new@x.com", "responseStatus": "accepted"}],
+        }
+        EventBuilder(self.user).save_events([cancelled])
+
+        exception = Event.objects.get(recurring_event_id="standup")
+        self.assertEqual(exception.organizer.email, "boss@x.com")
+        self.assertEqual(exception.status, "cancelled")
+
+    def test_occurrences_are_expanded_into_report(self):
+        EventBuilder(self.user).save_events([self._master()])
+        # The cancellation arrives in a later sync without the master
+        EventBuilder(self.user).save_events([self._cancelled(2)])
+
+        rb = ReportBuilder(self.user, num_months=3)
+        self.assertEqual(
+            rb.get_time_per_month(), [{"month": self.month.month, "time": timedelta(hours=2)}]
+        )
+        self.assertEqual(rb.get_most_and_least_meetings()[0]["count"], 4)
+        self.assertEqual(
+            rb.get_top_collaborators(num_people=3), [{"email": "testuser@wisc.edu", "count": 4}]
+        )
+
+    def test_occurrences_are_expanded_into_team_report(self):
+        EventBuilder(self.user).save_events([self._master(), self._cancelled(2)])
+
+        report = TeamReportBuilder([self.pc]).get_report()
+        metrics = report["calendars"]["ehansen8@wisc.edu"]
+        self.assertEqual(metrics["time_per_month"], [{"month": self.month.month, "time": timedelta(hours=2)}])
+        self.assertEqual(report["team"], [{"month": self.month.month, "count": 4, "time": timedelta(hours=2)}])
+
+
+class WatchRenewalTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        pc = Calendar.objects.create(email="ehansen8@wisc.edu")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=pc)
+        now = datetime.now(timezone.utc)
+        cls.channels = {}
+        for email, expires_in in (("soon@wisc.edu", timedelta(hours=1)), ("later@wisc.edu", timedelta(days=5))):
+            calendar = Calendar.objects.create(email=email)
+            cls.user.calendars.add(calendar)
+            cls.channels[email] = WatchChannel.objects.create(
+                id=uuid.uuid1(), resource_id=f"{email}-r", expiration=now + expires_in, calendar=calendar
+            )
+
+    def _manager(self, user, calendar, watch_config):
+        service = mock.Mock()
+        service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback)
+        manager = CalendarManager(user, calendar, watch_config=False, service=service)
+        expiration = int((datetime.now(timezone.utc) + timedelta(days=7)).timestamp() * 1000)
+        manager.watch_request = lambda channel_id: {"resourceId": "new", "expiration": str(expiration)}
+        manager.stop_watch = mock.Mock()
+        return manager
+
+    def test_expiring_channels_are_replaced_and_stopped(self):
+        managers = []
+
+        def build(user, calendar=None, watch_config=True, interactive=True):
+            managers.append(self._manager(user, calendar, watch_config))
+            return managers[-1]
+
+        with mock.patch("audit.fleet.CalendarManager", side_effect=build):
+            renewed, errors = renew_watches(timedelta(days=1))
+
+        self.assertEqual((renewed, errors), (1, {}))
+        old = self.channels["soon@wisc.edu"]
+        (manager,) = managers
+        manager.stop_watch.assert_called_once_with(channel_id=str(old.id), resource_id=old.resource_id)
+
+        channel = WatchChannel.objects.get(calendar__email="soon@wisc.edu")
+        self.assertNotEqual(channel.id, old.id)
+        self.assertEqual(channel.resource_id, "new")
+        self.assertGreater(channel.expiration, datetime.now(timezone.utc) + timedelta(days=6))
+        self.assertTrue(WatchChannel.objects.filter(pk=self.channels["later@wisc.edu"].pk).exists())
+
+
+@tag("slow", "benchmark")
+@skipUnless(os.environ.get("AUDIT_BENCHMARKS"), "Opt in with AUDIT_BENCHMARKS=1, wall times depend on the machine")
+class BenchmarkTests(TestCase):
+    def test_no_regressions_against_baseline(self):
+        baseline = harness.load_baseline()
+        if baseline["vendor"] != connection.vendor:
+            self.skipTest(f"The baseline was recorded on {baseline['vendor']}")
+
+        for name, recorded in baseline["scenarios"].items():
+            with self.subTest(scenario=name):
+                results = harness.run(harness.SCENARIOS[name])
+                self.assertEqual(harness.compare(results, recorded["results"], baseline["tolerance"]), [])
+
+
+recorded_spans = []
+
+
+def record_span(span):
+    recorded_spans.append(span)
+
+
+@override_settings(AUDIT_SPAN_HOOK="audit.tests.record_span")
+class InstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="UTC")
+        cls.user = User.objects.create(username="ehansen8", primary_calendar=cls.pc)
+
+    def setUp(self):
+        recorded_spans.clear()
+
+    def test_save_page_spans_count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            EventBuilder(self.user).save_events(
+                [event_data(g_id, attendees=["testuser@wisc.edu"]) for g_id in ("a", "b")]
+            )
+
+        spans = {span.name: span for span in recorded_spans}
+        self.assertEqual(set(spans), {"events.save_page", "events.create", "events.attendees"})
+        self.assertEqual(spans["events.save_page"].queries, len(ctx.captured_queries))
+        self.assertEqual(spans["events.create"].tags, {"events": 2})
+        self.assertEqual(spans["events.create"].queries, 1)
+
+    def test_report_metrics_are_spanned(self):
+        ReportBuilder(self.user).get_time_per_month()
+        self.assertEqual([span.name for span in recorded_spans], ["report.time_per_month"])
+
+    def test_metrics_view_exports_totals(self):
+        registry.clear()
+        with override_settings(AUDIT_SPAN_HOOK="audit.instrumentation.default_hook"):
+            EventBuilder(self.user).save_events([event_data("a", attendees=["testuser@wisc.edu"])])
+
+        with override_settings(AUDIT_METRICS_TOKEN="secret"):
+            response = self.client.get(reverse("audit:metrics"), headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('audit_span_seconds_count{span="events.save_page"} 1', response.content.decode())
+
+    def test_metrics_view_is_restricted(self):
+        url = reverse("audit:metrics")
+        # Requests through the tunnel come from localhost
+        self.assertEqual(self.client.get(url, REMOTE_ADDR="127.0.0.1").status_code, 403)
+        with override_settings(AUDIT_METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer wrong"}).status_code, 403)
+        with override_settings(AUDIT_METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer None"}).status_code, 403)
+
+        self.client.force_login(User.objects.create(username="admin", is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class ExportTests(TestCase):
+    def test_snapshot_round_trip(self):
+        pc = Calendar.objects.create(email="ehansen8@wisc.edu", timezone="UTC")
+        other = Calendar.objects.create(email="testuser@wisc.edu")
+        start = datetime(2022, 1, 3, 9, tzinfo=timezone.utc)
+        for i, summary in enumerate(("Standup", "Interview")):
+            event = Event.objects.create(
+                google_id=str(i),
+                organizer=other,
+                status="confirmed",
+                summary=summary,
+                event_type="default",
+                start=start + timedelta(days=i),
+                duration=timedelta(minutes=30),
+            )
+            event.calendars.add(pc)
+            Attendee.objects.create(event=event, calendar=other, response_status="accepted")
+            Attendee.objects.create(event=event, calendar=pc, response_status="tentative")
+
+        with tempfile.TemporaryDirectory() as path:
+            call_command("export_events", path, chunk_size=1, stdout=mock.Mock())
+            snap = snapshot.Snapshot(path)
+
+            self.assertEqual(snap.emails, ["ehansen8@wisc.edu", "testuser@wisc.edu"])
+            self.assertEqual(snap.manifest["rows"], {"events": 2, "links": 2, "attendees": 4})
+            epoch = int(start.timestamp())
+            self.assertEqual(list(snap.column("events", "start")), [epoch, epoch + 86400])
+            self.assertEqual(list(snap.column("events", "duration")), [1800, 1800])
+            self.assertEqual(list(snap.column("events", "organizer")), [1, 1])
+            self.assertEqual(list(snap.column("events", "flags")), [0, snapshot.RECRUITING])
+            self.assertEqual([calendar for _, calendar in snap.rows("links")], [0, 0])
+            self.assertEqual(
+                sorted((calendar, response) for _, calendar, response in snap.rows("attendees")),
+                [(0, 2), (0, 2), (1, 3), (1, 3)],
+            )
+
+    def test_interrupted_snapshot_is_rejected(self):
+        with tempfile.TemporaryDirectory() as path:
+            with self.assertRaises(ValueError):
+                snapshot.Snapshot(path)
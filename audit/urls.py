@@ -4,5 +4,6 @@ from . import views
 app_name = "audit"
 urlpatterns = [
     path("", views.index, name="index"),
-    path("watch/", views.watch, name="watch")
+    path("watch/", views.watch, name="watch"),
+    path("metrics/", views.metrics, name="metrics"),
 ]
@@ -1,16 +1,40 @@
 from datetime import datetime
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 import pytz
 
+# Meetings with any of these in their title count as recruiting time
+RECRUITING_KEYWORDS = ["recruiting", "interview"]
+
+
+def is_recruiting(summary: str) -> bool:
+    if not summary:
+        return False
+    summary = summary.lower()
+    return any(kw in summary for kw in RECRUITING_KEYWORDS)
+
+
+@lru_cache(maxsize=None)
+def get_tz(tz: str) -> ZoneInfo:
+    """Cached timezone lookup, calendars share a handful of timezones"""
+    return ZoneInfo(tz)
+
+
+def from_rfc3339(time: str) -> datetime:
+    """Convert an RFC 3339 timestamp with an offset or Z suffix (e.g. an event's `updated`) to an aware datetime"""
+    if time.endswith("Z"):
+        time = time[:-1] + "+00:00"
+    return datetime.fromisoformat(time)
+
+
 def to_dt(time: str, tz: str, as_date=False) -> datetime:
-    """ Convert RFC 3339 datetime string to a timezone aware datetime
-    Can handle datetimes as well as only dates"""
-    s = None
+    """ Convert RFC 3339 datetime string to a timezone aware datetime in tz
+    Can handle datetimes as well as only dates (midnight in tz)"""
     if as_date:
-        s = datetime.strptime(time, "%Y-%m-%d")
-    else:
-        s = datetime.strptime(time[:-6], "%Y-%m-%dT%H:%M:%S")
+        return datetime.fromisoformat(time).replace(tzinfo=get_tz(tz))
+    # The offset of the timestamp fixes the instant, tz only sets how it is presented
+    return from_rfc3339(time).astimezone(get_tz(tz))
 
-    return pytz.timezone(tz).localize(s)
 
 class DateUtil:
     """Date utility class primarily focused on getting the start of days/weeks/months
@@ -18,7 +42,8 @@ class DateUtil:
     """
 
     def __init__(self, dt: datetime = None, tz: str = None) -> None:
-        today = dt.date() if dt else datetime.now().date()
+        # Today is the date in tz, the boundaries are cut in the same timezone as the calendar's rollups
+        today = dt.date() if dt else datetime.now(pytz.timezone(tz)).date()
         self.year = today.year
         self.month = today.month
         self.week = today.isocalendar().week
@@ -1,40 +1,34 @@
+import hmac
+import uuid
+from django.conf import settings
 from django.shortcuts import redirect, render
 from django.http.request import HttpRequest
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseForbidden
 from .calendar_manager import CalendarManager
 from .reports import ReportBuilder
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
-from .models import User
+from .instrumentation import registry
+from .models import Calendar, WatchChannel
+from .sync_queue import enqueue_sync
 
 
 @login_required
 def index(request: HttpRequest) -> HttpResponse:
     user = request.user
-    m = CalendarManager(user)
-    m.sync_events(full_sync=False)
+    calendar = user.primary_calendar
+
+    # Render from the db and leave keeping it fresh to the webhook and background syncs,
+    # only the very first sync has to finish before there is anything to show
+    if not calendar or not calendar.last_synced:
+        CalendarManager(user).sync_events(full_sync=False)
+        calendar = user.primary_calendar
+    elif calendar.is_stale():
+        enqueue_sync(calendar.pk)
 
     rb = ReportBuilder(user, num_months=3)
+    context = {**rb.get_report(num_people=3), "last_synced": calendar.last_synced}
 
-    time_per_month = rb.get_time_per_month()
-    min_meetings, max_meetings = rb.get_most_and_least_meetings()
-    light_week, busy_week = rb.get_busiest_weeks()
-    avg_meetings_week = rb.get_avg_meetings_week()
-    avg_time_meetings_week = rb.get_avg_time_meetings_week()
-    top_collaborators = rb.get_top_collaborators(num_people=3)
-    time_recruiting = rb.get_time_recruiting()
-    
-    context = {
-        "time_per_month": time_per_month,
-        "min_meetings": min_meetings,
-        "max_meetings": max_meetings,
-        "light_week": light_week,
-        "busy_week": busy_week,
-        "avg_meetings_week": avg_meetings_week,
-        "avg_time_meetings_week": avg_time_meetings_week,
-        "top_collaborators": top_collaborators,
-        "time_recruiting": time_recruiting,
-    }
     return render(request, "index.html", context=context)
 
 
@@ -49,12 +43,41 @@ def home(request: HttpRequest) -> HttpResponse:
 @csrf_exempt
 def watch(request) -> HttpResponse:
 
-    calendar_email = request.headers.get("X-Goog-Channel-Token")
     state = request.headers.get("X-Goog-Resource-State")
 
     # This Skips Sync notifications
     if state == "exists":
-        user = User.objects.get(primary_calendar__email=calendar_email)
-        m = CalendarManager(user=user).sync_events(full_sync=False)
+        try:
+            channel_id = uuid.UUID(request.headers.get("X-Goog-Channel-ID", ""))
+            message_number = int(request.headers.get("X-Goog-Message-Number", ""))
+        except ValueError:
+            return HttpResponse(status=200)
+
+        # Claim the message atomically, repeated and out of order deliveries
+        # as well as notifications of unknown (e.g. replaced) channels update nothing
+        claimed = WatchChannel.objects.filter(id=channel_id, message_number__lt=message_number).update(
+            message_number=message_number
+        )
+        if not claimed:
+            return HttpResponse(status=200)
+
+        calendar_id = (
+            Calendar.objects.filter(channel__id=channel_id, readers__isnull=False)
+            .values_list("pk", flat=True)
+            .first()
+        )
+        if calendar_id:
+            # Only queue the sync, Google retries the notification if we take too long to respond
+            enqueue_sync(calendar_id)
 
     return HttpResponse(status=200)
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    """Prometheus text export of the sync and report spans, only served to staff and to scrapers with
+    the AUDIT_METRICS_TOKEN. The remote address isn't trusted, the tunnel forwards every request from localhost"""
+    token = settings.AUDIT_METRICS_TOKEN
+    authorized = token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+    if not authorized and not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.export(), content_type="text/plain; version=0.0.4")
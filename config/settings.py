@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+from datetime import timedelta
 from pathlib import Path
 from .secrets import *
 
@@ -32,6 +33,48 @@ CSRF_TRUSTED_ORIGINS =["https://7680-24-121-68-47.ngrok.io"]
 LOGIN_REDIRECT_URL = "home"
 LOGOUT_REDIRECT_URL = "home"
 
+# Number of worker threads that run background calendar syncs
+AUDIT_SYNC_WORKERS = 2
+
+# Seconds a queued sync waits for more push notifications of the same calendar before it starts
+AUDIT_SYNC_DEBOUNCE = 2
+
+# A sync that hasn't checkpointed a page for this long is presumed dead and its calendar can be claimed again
+AUDIT_SYNC_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+# Seconds before a background sync skipped because another process was syncing the calendar is retried
+AUDIT_SYNC_CLAIM_RETRY = 30
+
+# The dashboard schedules a background sync when the last one is older than this
+AUDIT_SYNC_STALENESS = timedelta(minutes=15)
+
+# A calendar's first sync only fetches events within this far of now (the report window plus a margin),
+# older and later events are backfilled in the background. None fetches everything up front
+AUDIT_INITIAL_SYNC_PAST = timedelta(days=31 * 4)
+AUDIT_INITIAL_SYNC_FUTURE = timedelta(days=31)
+
+# Store events the way the Calendar API expands them, one row per occurrence. When off, recurring events are
+# stored as a master with its RRULE and exceptions and only expanded for the report window.
+# Changing it needs a full sync (sync_calendars --full) as the sync tokens depend on it
+AUDIT_EXPAND_RECURRING = True
+
+# Watch channels expiring within this are renewed by the renew_watches command
+AUDIT_WATCH_RENEWAL_HORIZON = timedelta(days=1)
+
+# Called with every finished instrumentation span (audit.instrumentation.Span), the default logs it
+# and adds it to the totals served by the metrics view
+AUDIT_SPAN_HOOK = "audit.instrumentation.default_hook"
+
+# Token a metrics scraper sends as "Authorization: Bearer <token>", optional METRICS_TOKEN in secrets.py.
+# Without it the metrics view is only served to staff
+AUDIT_METRICS_TOKEN = globals().get("METRICS_TOKEN")
+
+# Max number of users whose built Calendar API service is kept in memory
+AUDIT_SERVICE_POOL_SIZE = 128
+
+# Seconds a computed report stays cached, entries are invalidated early by any sync that writes events
+AUDIT_REPORT_CACHE_TIMEOUT = 60 * 60 * 24
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -89,6 +132,13 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "calendar-audit",
+    }
+}
+
 AUTH_USER_MODEL = "audit.User"
 
 # Password validation